@@ -3,6 +3,7 @@
 
 import argparse
 import collections
+import io
 import json
 import openreview
 import os
@@ -10,6 +11,7 @@ import pikepdf
 import tqdm
 
 import scc_lib
+import scc_storage_lib
 
 parser = argparse.ArgumentParser(description='')
 parser.add_argument('-d',
@@ -28,6 +30,13 @@ parser.add_argument('-r',
                     default='./records/',
                     type=str,
                     help='saving outcomes of each stage')
+parser.add_argument('-l',
+                    '--layout',
+                    default=None,
+                    type=str,
+                    choices=scc_storage_lib.Layout.ALL,
+                    help='storage layout (default: detect)')
+scc_lib.add_shard_arguments(parser)
 
 # == OpenReview-specific stuff ===============================================
 
@@ -97,21 +106,17 @@ def get_binary(note):
         pdf_binary = None
     return pdf_status, pdf_binary
 
-def write_pdf(forum_dir, pdf_binary, version_name):
+def write_pdf(storage, forum_id, pdf_binary, version_name):
     assert pdf_binary is not None
-    full_pdf_path = f'{forum_dir}/{version_name}_full.pdf'
-    pdf_path = f'{forum_dir}/{version_name}.pdf'
-    with open(full_pdf_path, "wb") as f:
-        f.write(pdf_binary)
-    full_pdf = pikepdf.Pdf.open(full_pdf_path)
+    full_pdf = pikepdf.Pdf.open(io.BytesIO(pdf_binary))
     truncated_pdf = pikepdf.Pdf.new()
     for page_num in range(3):
         try:
             truncated_pdf.pages.append(full_pdf.pages[page_num])
         except IndexError:
             break  # Sometimes there are fewer than 3 pages
-    truncated_pdf.save(pdf_path)
-    os.remove(full_pdf_path)
+    with storage.open(forum_id, f'{version_name}.pdf', 'wb') as f:
+        truncated_pdf.save(f)
 
 
 def write_pdfs(forum_dir, initial_binary, final_binary):
@@ -227,7 +232,7 @@ def get_reference_url(reference_id):
     return f'{PDF_URL_PREFIX}{reference_id}'
 
 
-def get_versions_and_write_pdfs(forum_id, forum_dir, metareview_date, review_notes):
+def get_versions_and_write_pdfs(forum_id, storage, metareview_date, review_notes):
     # Retrieve all revisions of the manuscript in order of submission
     references = sorted(GUEST_CLIENT.get_all_references(referent=forum_id,
                                                         original=True),
@@ -256,7 +261,7 @@ def get_versions_and_write_pdfs(forum_id, forum_dir, metareview_date, review_not
     url_builder[scc_lib.SUBMITTED] = get_reference_url(
             submitted_id
        )
-    write_pdf(forum_dir, version_binaries[scc_lib.SUBMITTED],
+    write_pdf(storage, forum_id, version_binaries[scc_lib.SUBMITTED],
         scc_lib.SUBMITTED)
     valid_versions = [submitted_id]
 
@@ -265,7 +270,7 @@ def get_versions_and_write_pdfs(forum_id, forum_dir, metareview_date, review_not
             version_id = version_references[next_version].id
             if version_id not in valid_versions:
                 valid_versions.append(version_id)
-                write_pdf(forum_dir, version_binaries[next_version],
+                write_pdf(storage, forum_id, version_binaries[next_version],
                 next_version)
                 url_builder[next_version] = get_reference_url(version_id)
 
@@ -275,7 +280,7 @@ def get_versions_and_write_pdfs(forum_id, forum_dir, metareview_date, review_not
         return scc_lib.DownloadStatus.COMPLETE, url_builder
 
 
-def process_forum(forum, conference, forum_dir):
+def process_forum(forum, conference, storage):
 
     # Things needed for metadata:
     metadata_builder = {
@@ -312,58 +317,57 @@ def process_forum(forum, conference, forum_dir):
     if metadata_builder['decision'] is None:
         return scc_lib.DownloadStatus.NO_DECISION, metadata_builder
 
-    status, urls = get_versions_and_write_pdfs(forum.id, forum_dir, metareview_date, review_notes)
+    status, urls = get_versions_and_write_pdfs(forum.id, storage, metareview_date, review_notes)
 
     metadata_builder['urls'] = urls
 
     return status, metadata_builder
 
 
-def process_forum_wrapper(forum, conference, output_dir):
-
-    # Create a directory for the forum
-    forum_dir = f'{output_dir}/{forum.id}'
-    os.makedirs(forum_dir, exist_ok=True)
+def download_forum(forum, conference, storage):
+    """Write a forum's PDFs and metadata to storage, and return its
+    OpenReviewRecord."""
 
-    status, metadata = process_forum(forum, conference, forum_dir)
-    with open(f'{forum_dir}/metadata.json', 'w') as f:
+    status, metadata = process_forum(forum, conference, storage)
+    with storage.open(forum.id, 'metadata.json', 'w') as f:
         f.write(json.dumps(metadata, indent=2))
 
-    return status, metadata['decision']
+    return OpenReviewRecord(conference, forum.id, status,
+                            metadata['decision'])
+
+
+def get_forum_notes(conference):
+    # Gets top level notes for each `forum' (each paper submission is assigned
+    # a forum)
+    return GUEST_CLIENT.get_all_notes(invitation=INVITATIONS[conference])
 
 
 def main():
 
     args = parser.parse_args()
 
-    # A directory will be made for each paper submission under the output directory.
-    final_dir = f'{args.dir}/{args.conference}/'
-    os.makedirs(final_dir, exist_ok=True)
+    # Files of each paper submission are written to the conference's storage
+    # (a directory per submission, or packed segment files).
+    storage = scc_storage_lib.open_storage(args.dir, args.conference,
+                                           args.layout)
 
-    # Gets top level notes for each `forum' (each paper submission is assigned
-    # a forum)
-    forum_notes = GUEST_CLIENT.get_all_notes(
-        invitation=INVITATIONS[args.conference])
+    forum_notes = get_forum_notes(args.conference)
 
     downloads_already_done = scc_lib.get_records(args.record_directory,
                                                  args.conference,
                                                  scc_lib.Stage.DOWNLOAD)
+    shard = scc_lib.get_work_shard(args, scc_lib.Stage.DOWNLOAD)
 
-    with open(
-            scc_lib.get_record_filename(args.record_directory, args.conference,
-                                        scc_lib.Stage.DOWNLOAD), 'a') as f:
+    with open(shard.record_filename(args.record_directory), 'a') as f:
         for forum in tqdm.tqdm(forum_notes):
             if forum.id in downloads_already_done:
                 continue
+            if not shard.owns(forum.id):
+                continue
 
-            # Process a forum. As a side effect, write pdfs to directory.
-            status, decision = process_forum_wrapper(forum, args.conference,
-                                                     final_dir)
-            f.write(
-                json.dumps(
-                    OpenReviewRecord(args.conference, forum.id, status,
-                                     decision)._asdict()) + "\n")
-            f.flush()
+            # Process a forum. As a side effect, write pdfs to storage.
+            scc_lib.write_record(
+                download_forum(forum, args.conference, storage), f)
 
 
 if __name__ == "__main__":
@@ -4,12 +4,12 @@
 import argparse
 import collections
 import json
-import os
 import re
 import tqdm
 import subprocess
 
 import scc_lib
+import scc_storage_lib
 
 parser = argparse.ArgumentParser(description="")
 parser.add_argument(
@@ -29,6 +29,13 @@ parser.add_argument('-r',
                     default='./records/',
                     type=str,
                     help='prefix for tsv file with status of all forums')
+parser.add_argument('-l',
+                    '--layout',
+                    default=None,
+                    type=str,
+                    choices=scc_storage_lib.Layout.ALL,
+                    help='storage layout (default: detect)')
+scc_lib.add_shard_arguments(parser)
 
 VERSION_FIELDS = "title abstract intro debug_next_sec".split()
 Version = collections.namedtuple("Version", VERSION_FIELDS)
@@ -161,10 +168,13 @@ def parse_clean_text(text):
     return Version(title, abstract, introduction, next_sec)
 
 
-def process_pdf(pdf_path):
-    if not os.path.exists(pdf_path):
+def process_pdf(storage, forum_id, version_name):
+    pdf_name = f'{version_name}.pdf'
+    if not storage.exists(forum_id, pdf_name):
         return None
-    maybe_text = extract_text(pdf_path)
+    # pdftotext needs a file on disk
+    with storage.local_path(forum_id, pdf_name) as pdf_path:
+        maybe_text = extract_text(pdf_path)
     if maybe_text is None:
         return scc_lib.ExtractionStatus.PDF_PARSE_ERROR
     elif not maybe_text:
@@ -174,16 +184,79 @@ def process_pdf(pdf_path):
             clean_hyphenation(remove_boilerplate(maybe_text)))
 
 
+def extract_forum(storage, conference, forum_id):
+    """Extract the text of each downloaded version of a forum.
+
+    If at least two versions could be parsed, their texts are written to
+    texts.json. Returns the ExtractionRecord, and the texts.json object (or
+    None).
+    """
+    processed_texts = {}
+    for version_name in scc_lib.VERSIONS:
+        maybe_processed_pdf = process_pdf(storage, forum_id, version_name)
+        if maybe_processed_pdf is not None:
+            processed_texts[version_name] = maybe_processed_pdf
+
+    valid_versions = [
+        v for v in processed_texts.values() if isinstance(v, Version)
+    ]
+    errors = [e for e in processed_texts.values() if isinstance(e, str)]
+    if len(valid_versions) < 2:
+        if not errors:
+            record = ExtractionRecord(conference, forum_id,
+                                      scc_lib.ExtractionStatus.NO_CHANGE,
+                                      None)
+        else:
+            details = []
+            for version_name, maybe_error in processed_texts.items():
+                if isinstance(maybe_error, str):
+                    details.append(f'{version_name}_{maybe_error}')
+            record = ExtractionRecord(conference, forum_id,
+                                      scc_lib.ExtractionStatus.ERROR,
+                                      "|".join(details))
+        return record, None
+
+    # At least 2 versions -- some diffs to look at
+    prepared_processed_texts = {}
+    details = []
+    for version_name, maybe_version in processed_texts.items():
+        if maybe_version is None:
+            prepared_processed_texts[version_name] = None
+        elif isinstance(maybe_version, str):
+            details.append(f'{version_name}_{maybe_version}')
+            prepared_processed_texts[version_name] = None
+        else:
+            prepared_processed_texts[version_name] = maybe_version._asdict()
+    paper = Paper(
+        conference,
+        forum_id,
+        prepared_processed_texts.get(scc_lib.SUBMITTED, None),
+        prepared_processed_texts.get(scc_lib.DISCUSSED, None),
+        prepared_processed_texts.get(scc_lib.FINAL, None),
+    )
+    with storage.open(forum_id, 'texts.json', 'w') as g:
+        g.write(json.dumps(paper._asdict(), indent=2))
+    if details:
+        record = ExtractionRecord(conference, forum_id,
+                                  scc_lib.ExtractionStatus.ERROR,
+                                  "|".join(details))
+    else:
+        record = ExtractionRecord(conference, forum_id,
+                                  scc_lib.ExtractionStatus.COMPLETE, None)
+    return record, paper._asdict()
+
+
 def main():
     args = parser.parse_args()
 
+    storage = scc_storage_lib.open_storage(args.data_dir, args.conference,
+                                           args.layout)
     extraction_already_done = scc_lib.get_records(args.record_directory,
                                                   args.conference,
                                                   scc_lib.Stage.EXTRACT)
+    shard = scc_lib.get_work_shard(args, scc_lib.Stage.EXTRACT)
 
-    with open(
-            scc_lib.get_record_filename(args.record_directory, args.conference,
-                                        scc_lib.Stage.EXTRACT), 'a') as f:
+    with open(shard.record_filename(args.record_directory), 'a') as f:
 
         for forum_id in tqdm.tqdm(
                 scc_lib.get_records(args.record_directory,
@@ -193,69 +266,11 @@ def main():
 
             if forum_id in extraction_already_done:
                 continue
+            if not shard.owns(forum_id):
+                continue
 
-            processed_texts = {}
-            for version_name in scc_lib.VERSIONS:
-                pdf_path = f"{args.data_dir}/{args.conference}/{forum_id}/{version_name}.pdf"
-                maybe_processed_pdf = process_pdf(pdf_path)
-                if maybe_processed_pdf is not None:
-                    processed_texts[version_name] = maybe_processed_pdf
-
-            valid_versions = [
-                v for v in processed_texts.values() if isinstance(v, Version)
-            ]
-            errors = [
-                e for e in processed_texts.values() if isinstance(e, str)
-            ]
-            if len(valid_versions) < 2:
-                if not errors:
-                    record = ExtractionRecord(
-                        args.conference, forum_id,
-                        scc_lib.ExtractionStatus.NO_CHANGE, None)
-                else:
-                    details = []
-                    for version_name, maybe_error in processed_texts.items():
-                        if isinstance(maybe_error, str):
-                            details.append(f'{version_name}_{maybe_error}')
-                    record = ExtractionRecord(args.conference, forum_id,
-                                              scc_lib.ExtractionStatus.ERROR,
-                                              "|".join(details))
-            else:
-                # At least 2 versions -- some diffs to look at
-                prepared_processed_texts = {}
-                details = []
-                for version_name, maybe_version in processed_texts.items():
-                    if maybe_version is None:
-                        prepared_processed_texts[version_name] = None
-                    elif isinstance(maybe_version, str):
-                        details.append(f'{version_name}_{maybe_error}')
-                        prepared_processed_texts[version_name] = None
-                    else:
-                        prepared_processed_texts[
-                            version_name] = maybe_version._asdict()
-                paper = Paper(
-                    args.conference,
-                    forum_id,
-                    prepared_processed_texts.get(scc_lib.SUBMITTED, None),
-                    prepared_processed_texts.get(scc_lib.DISCUSSED, None),
-                    prepared_processed_texts.get(scc_lib.FINAL, None),
-                )
-                with open(
-                        f'{args.data_dir}/{args.conference}/{forum_id}/texts.json',
-                        'w') as g:
-                    g.write(json.dumps(paper._asdict(), indent=2))
-                if details:
-                    details = "|".join(details)
-                    record = ExtractionRecord(args.conference, forum_id,
-                                          scc_lib.ExtractionStatus.ERROR,
-                                          details)
-                else:
-                    details = None
-                    record = ExtractionRecord(args.conference, forum_id,
-                                          scc_lib.ExtractionStatus.COMPLETE,
-                                          details)
-
-                scc_lib.write_record(record, f)
+            record, _ = extract_forum(storage, args.conference, forum_id)
+            scc_lib.write_record(record, f)
 
 
 if __name__ == "__main__":
@@ -12,6 +12,8 @@ import stanza
 
 import scc_lib
 import scc_diff_lib
+import scc_storage_lib
+import scc_store_lib
 
 parser = argparse.ArgumentParser(description="")
 parser.add_argument(
@@ -31,9 +33,70 @@ parser.add_argument('-r',
                     default='./records/',
                     type=str,
                     help='prefix for tsv file with status of all forums')
+parser.add_argument('-l',
+                    '--layout',
+                    default=None,
+                    type=str,
+                    choices=scc_storage_lib.Layout.ALL,
+                    help='storage layout (default: detect)')
+scc_lib.add_shard_arguments(parser)
+
+
+def add_diff_arguments(parser):
+    """Options of the compute stage, shared with pipeline.py."""
+    parser.add_argument('-m',
+                        '--matching_engine',
+                        default=scc_diff_lib.MatchingEngine.DIFFLIB,
+                        type=str,
+                        choices=scc_diff_lib.MatchingEngine.ALL,
+                        help='algorithm for finding maximal matching blocks')
+    parser.add_argument('-e',
+                        '--edit_script_engine',
+                        default=scc_diff_lib.EditScriptEngine.MYERS,
+                        type=str,
+                        choices=scc_diff_lib.EditScriptEngine.ALL,
+                        help='algorithm for diffing within nonmatching blocks')
+    parser.add_argument('-v',
+                        '--verification_level',
+                        default=scc_diff_lib.VerificationLevel.FULL,
+                        type=str,
+                        choices=scc_diff_lib.VerificationLevel.ALL,
+                        help='how thoroughly to check diffs by reconstruction')
+    parser.add_argument('-o',
+                        '--output_format',
+                        default=scc_store_lib.OutputFormat.JSON,
+                        type=str,
+                        choices=scc_store_lib.OutputFormat.ALL,
+                        help=('json, or binary with one token store '
+                              'per version'))
+    parser.add_argument('-s',
+                        '--hierarchical',
+                        action='store_true',
+                        help=('align sentences first, and output '
+                              'sentence pairs'))
+    parser.add_argument('-t',
+                        '--categorize',
+                        action='store_true',
+                        help=('store diff type and scope in outputs '
+                              'and records'))
+
+
+add_diff_arguments(parser)
+
+DiffOptions = collections.namedtuple(
+    "DiffOptions", ("matching_engine edit_script_engine verification_level "
+                    "output_format hierarchical categorize").split())
+
+
+def get_diff_options(args):
+    return DiffOptions(
+        *[getattr(args, field) for field in DiffOptions._fields])
+
 
 DiffingRecord = collections.namedtuple(
-    "DiffingRecord", "conference forum_id part source dest status".split())
+    "DiffingRecord",
+    ("conference forum_id part source dest status lumped_blocks "
+     "categories").split())
 
 SENTENCIZE_PIPELINE = stanza.Pipeline("en", processors="tokenize")
 
@@ -43,22 +106,127 @@ def get_tokens(text):
                 for s in SENTENCIZE_PIPELINE(text).sentences)
 
 
+def categorize(d):
+    """Get (type, scope) of each diff, and counts by type and scope."""
+    if not d.source_tokens:
+        return None, None
+    categories = scc_lib.get_diff_types_and_scopes([
+        scc_lib.get_categorizable_diff(diff._asdict(), d.source_tokens,
+                                       d.dest_tokens) for diff in d.diffs
+    ], scc_lib.SentenceIndex(d.source_unflat))
+    counts = collections.defaultdict(collections.Counter)
+    for diff_type, diff_scope in categories:
+        counts[diff_type][diff_scope] += 1
+    return categories, counts
+
+
+def write_diffs(d, storage, forum_id, part, source, dest, output_format,
+                written_stores):
+    """written_stores holds the (version, part) token stores already written
+    for this forum in this run. Stores from earlier runs are always
+    rewritten, since the texts or tokenization may have changed since."""
+    name = scc_store_lib.get_diffs_name(part, source, dest, output_format)
+    if output_format == scc_store_lib.OutputFormat.BINARY:
+        # Token stores are shared between all pairs involving a version
+        for version, unflat_tokens in [(source, d.source_unflat),
+                                       (dest, d.dest_unflat)]:
+            if (version, part) not in written_stores:
+                store_name = scc_store_lib.get_token_store_name(part, version)
+                with storage.open(forum_id, store_name, 'wb') as h:
+                    scc_store_lib.write_token_store(h, unflat_tokens)
+                written_stores.add((version, part))
+        with storage.open(forum_id, name, 'wb') as h:
+            scc_store_lib.write_diffs(h, part, source, dest, d.diffs,
+                                      d.get_alignment(), d.sentence_pairs,
+                                      d.categories)
+    else:
+        with storage.open(forum_id, name, 'w') as h:
+            d.write(h)
+
+
+POSSIBLE_PAIRS = [
+    (scc_lib.SUBMITTED, scc_lib.DISCUSSED),
+    (scc_lib.DISCUSSED, scc_lib.FINAL),
+    (scc_lib.SUBMITTED, scc_lib.FINAL),
+]
+
+
+def compute_forum(storage, conference, forum_id, options, obj=None):
+    """Diff the abstract and intro of each pair of extracted versions.
+
+    obj is the forum's texts.json object; it is read from storage if not
+    given. Diffs are written to storage, and a DiffingRecord is returned for
+    each (part, pair).
+    """
+    if obj is None:
+        with storage.open(forum_id, 'texts.json', 'r') as g:
+            obj = json.load(g)
+
+    pairs_to_diff = []
+    for source, dest in POSSIBLE_PAIRS:
+        if obj[source] is not None and obj[dest] is not None:
+            pairs_to_diff.append((source, dest))
+
+    # Each version is tokenized only once
+    tokens = {}
+    document_diffs = {}
+    written_stores = set()
+    records = []
+
+    for source, dest in pairs_to_diff:
+        for part in ['abstract', 'intro']:
+            for version in [source, dest]:
+                if (version, part) not in tokens:
+                    tokens[version, part] = get_tokens(obj[version][part])
+            # If both adjacent-version diffs exist, submitted -> final is
+            # derived from them (except in hierarchical mode, where sentence
+            # pairs are needed).
+            first = document_diffs.get((source, scc_lib.DISCUSSED, part))
+            second = document_diffs.get((scc_lib.DISCUSSED, dest, part))
+            if (not options.hierarchical and first is not None
+                    and first.error is None and second is not None
+                    and second.error is None):
+                d = scc_diff_lib.compose(
+                    first,
+                    second,
+                    edit_script_engine=options.edit_script_engine,
+                    verification_level=options.verification_level)
+            else:
+                d = scc_diff_lib.DocumentDiff(
+                    tokens[source, part],
+                    tokens[dest, part],
+                    matching_engine=options.matching_engine,
+                    edit_script_engine=options.edit_script_engine,
+                    verification_level=options.verification_level,
+                    hierarchical=options.hierarchical)
+            document_diffs[source, dest, part] = d
+            category_counts = None
+            if d.error is None:
+                result = "complete"
+                if options.categorize:
+                    d.categories, category_counts = categorize(d)
+                write_diffs(d, storage, forum_id, part, source, dest,
+                            options.output_format, written_stores)
+            else:
+                result = d.error
+            records.append(
+                DiffingRecord(conference, forum_id, part, source, dest,
+                              result, d.lumped_blocks, category_counts))
+    return records
+
+
 def main():
     args = parser.parse_args()
 
+    storage = scc_storage_lib.open_storage(args.data_dir, args.conference,
+                                           args.layout)
+    options = get_diff_options(args)
     diffs_already_done = scc_lib.get_records(args.record_directory,
                                              args.conference,
                                              scc_lib.Stage.COMPUTE)
+    shard = scc_lib.get_work_shard(args, scc_lib.Stage.COMPUTE)
 
-    possible_pairs = [
-        (scc_lib.SUBMITTED, scc_lib.DISCUSSED),
-        (scc_lib.DISCUSSED, scc_lib.FINAL),
-        (scc_lib.SUBMITTED, scc_lib.FINAL),
-    ]
-
-    with open(
-            scc_lib.get_record_filename(args.record_directory, args.conference,
-                                        scc_lib.Stage.COMPUTE), 'a') as f:
+    with open(shard.record_filename(args.record_directory), 'a') as f:
 
         for forum_id in tqdm.tqdm(
                 scc_lib.get_records(args.record_directory,
@@ -68,32 +236,12 @@ def main():
 
             if forum_id in diffs_already_done:
                 continue
+            if not shard.owns(forum_id):
+                continue
 
-            texts_filename = f'{args.data_dir}/{args.conference}/{forum_id}/texts.json'
-            with open(texts_filename, 'r') as g:
-                obj = json.load(g)
-
-                pairs_to_diff = []
-                for source, dest in possible_pairs:
-                    if obj[source] is not None and obj[dest] is not None:
-                        pairs_to_diff.append((source, dest))
-
-                for source, dest in pairs_to_diff:
-                    key = f'{source}_{dest}'
-                    for part in ['abstract', 'intro']:
-                        filename = texts_filename.replace(
-                            'texts', f'diffs_{part}_{key}')
-                        d = scc_diff_lib.DocumentDiff(get_tokens(obj[source][part]),
-                                                      get_tokens(obj[dest][part]))
-                        if d.error is None:
-                            result = "complete"
-                            with open(filename, 'w') as h:
-                                h.write(d.dump())
-                        else:
-                            result = d.error
-                        scc_lib.write_record(
-                            DiffingRecord(args.conference, forum_id, part,
-                                          source, dest, result), f)
+            for record in compute_forum(storage, args.conference, forum_id,
+                                        options):
+                scc_lib.write_record(record, f)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+"""Compare matching block engines on already-tokenized document pairs.
+
+Token pairs are read from the diff files written by 02_compute.py, so no
+tokenization is repeated here.
+"""
+
+import argparse
+import difflib
+import time
+import tqdm
+
+import scc_lib
+import scc_diff_lib
+import scc_storage_lib
+import scc_store_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument(
+    "-d",
+    "--data_dir",
+    type=str,
+    help="Data dir",
+)
+parser.add_argument("-c",
+                    "--conference",
+                    type=str,
+                    choices=scc_lib.Conference.ALL,
+                    help="conference_year, e.g. iclr_2022",
+                    required=True)
+parser.add_argument('-r',
+                    '--record_directory',
+                    default='./records/',
+                    type=str,
+                    help='prefix for tsv file with status of all forums')
+parser.add_argument('-p',
+                    '--part',
+                    default='intro',
+                    type=str,
+                    choices=['abstract', 'intro'],
+                    help='which part of the paper to benchmark on')
+parser.add_argument('-n',
+                    '--max_pairs',
+                    default=200,
+                    type=int,
+                    help='number of document pairs to benchmark on')
+parser.add_argument('-o',
+                    '--output_format',
+                    default=scc_store_lib.OutputFormat.JSON,
+                    type=str,
+                    choices=scc_store_lib.OutputFormat.ALL,
+                    help='format the diffs were written in')
+
+
+def get_matched_tokens(matching_blocks):
+    return sum(b.size for b in matching_blocks
+               if b.size > scc_diff_lib.MIN_MATCHING_BLOCK_LEN)
+
+
+def main():
+    args = parser.parse_args()
+
+    records = [
+        r for r in scc_lib.get_records(args.record_directory,
+                                       args.conference,
+                                       scc_lib.Stage.COMPUTE,
+                                       complete_only=True,
+                                       full_records=True)
+        if r['part'] == args.part
+    ][:args.max_pairs]
+
+    times = {engine: 0.0 for engine in scc_diff_lib.MatchingEngine.ALL}
+    matched_tokens = {engine: 0 for engine in scc_diff_lib.MatchingEngine.ALL}
+    total_tokens = 0
+
+    storage = scc_storage_lib.open_storage(args.data_dir, args.conference)
+    for r in tqdm.tqdm(records):
+        obj = scc_store_lib.load_document_diff(
+            storage, r['forum_id'],
+            scc_store_lib.get_diffs_name(r['part'], r['source'], r['dest'],
+                                         args.output_format))
+        source = scc_diff_lib.flatten_sentences(obj['tokens']['source'])
+        dest = scc_diff_lib.flatten_sentences(obj['tokens']['dest'])
+        total_tokens += len(source) + len(dest)
+
+        for engine in scc_diff_lib.MatchingEngine.ALL:
+            start = time.perf_counter()
+            if engine == scc_diff_lib.MatchingEngine.PATIENCE:
+                blocks = scc_diff_lib.patience_matching_blocks(source, dest)
+            else:
+                blocks = difflib.SequenceMatcher(
+                    None, source, dest).get_matching_blocks()
+            times[engine] += time.perf_counter() - start
+            matched_tokens[engine] += get_matched_tokens(blocks)
+
+    print(f"{len(records)} pairs, {total_tokens} tokens")
+    for engine in scc_diff_lib.MatchingEngine.ALL:
+        print(f"{engine}\t{times[engine]:.3f}s\t"
+              f"{matched_tokens[engine]} tokens in matching blocks")
+
+
+if __name__ == "__main__":
+    main()
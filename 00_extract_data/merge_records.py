@@ -0,0 +1,80 @@
+"""Merge the per-shard record files of sharded stage runs into the stage
+record files.
+
+Run this once all tasks of a sharded run have finished. Records already in
+the stage record file are not duplicated, so an interrupted merge can be
+re-run.
+"""
+
+import argparse
+import os
+
+import scc_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument('-r',
+                    '--record_directory',
+                    default='./records/',
+                    type=str,
+                    help='prefix for tsv file with status of all forums')
+parser.add_argument("-c",
+                    "--conference",
+                    type=str,
+                    choices=scc_lib.Conference.ALL,
+                    help="only merge this conference")
+parser.add_argument('-s',
+                    '--stage',
+                    type=str,
+                    choices=scc_lib.Stage.ALL,
+                    help='only merge this stage')
+
+
+def read_lines(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as f:
+        return [l if l.endswith("\n") else l + "\n" for l in f]
+
+
+def merge_records(record_directory, conference, stage):
+    """Returns the number of records added to the stage record file."""
+    shard_filenames = scc_lib.get_shard_record_filenames(
+        record_directory, conference, stage)
+    if not shard_filenames:
+        return 0
+    filename = scc_lib.get_record_filename(record_directory, conference,
+                                           stage)
+    lines = read_lines(filename)
+    seen = set(lines)
+    new_lines = []
+    for shard_filename in shard_filenames:
+        for line in read_lines(shard_filename):
+            if line not in seen:
+                seen.add(line)
+                new_lines.append(line)
+
+    temp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(temp_filename, 'w') as f:
+        f.writelines(lines + new_lines)
+    os.replace(temp_filename, filename)
+    for shard_filename in shard_filenames:
+        os.remove(shard_filename)
+    return len(new_lines)
+
+
+def main():
+    args = parser.parse_args()
+
+    conferences = ([args.conference]
+                   if args.conference else scc_lib.Conference.ALL)
+    stages = [args.stage] if args.stage else scc_lib.Stage.ALL
+    for conference in conferences:
+        for stage in stages:
+            num_merged = merge_records(args.record_directory, conference,
+                                       stage)
+            if num_merged:
+                print(f'{conference} {stage}: {num_merged} records merged')
+
+
+if __name__ == "__main__":
+    main()
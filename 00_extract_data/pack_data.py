@@ -0,0 +1,49 @@
+"""Convert a conference from one directory per forum to packed storage.
+
+Artifacts already in packed storage are skipped, so an interrupted run can be
+resumed. The forum directories are left in place; once the packed copy has
+been checked, they can be removed.
+"""
+
+import argparse
+import tqdm
+
+import scc_lib
+import scc_storage_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument(
+    "-d",
+    "--data_dir",
+    type=str,
+    help="Data dir",
+)
+parser.add_argument("-c",
+                    "--conference",
+                    type=str,
+                    choices=scc_lib.Conference.ALL,
+                    help="conference_year, e.g. iclr_2022",
+                    required=True)
+
+
+def main():
+    args = parser.parse_args()
+
+    directory_storage = scc_storage_lib.DirectoryStorage(
+        args.data_dir, args.conference)
+    packed_storage = scc_storage_lib.PackedStorage(args.data_dir,
+                                                   args.conference)
+
+    num_copied = 0
+    for forum_id in tqdm.tqdm(directory_storage.forum_ids()):
+        for name in directory_storage.names(forum_id):
+            if not packed_storage.exists(forum_id, name):
+                scc_storage_lib.copy_artifact(directory_storage,
+                                              packed_storage, forum_id, name)
+                num_copied += 1
+    print(f'{num_copied} artifacts packed into '
+          f'{packed_storage.packed_directory}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""Run download, extraction and diffing of a conference as one pipeline.
+
+Each forum flows through the three stages as soon as the previous one is done
+with it, so the network-bound downloads overlap with the CPU-bound extraction
+and diffing:
+
+    download threads -> extract threads -> diffing processes
+
+Stages are connected by bounded queues, so a fast stage cannot run far ahead
+of a slow one. Every stage appends to its own record file, exactly as
+00_download.py, 01_extract.py and 02_compute.py do, so a stopped pipeline can
+be resumed by the pipeline or by the stage scripts. With sharding options,
+forums are split across tasks at each stage as in the stage scripts.
+"""
+
+import argparse
+import importlib
+import multiprocessing
+import queue
+import threading
+import traceback
+import tqdm
+
+import scc_lib
+import scc_storage_lib
+
+download_stage = importlib.import_module("00_download")
+extract_stage = importlib.import_module("01_extract")
+compute_stage = importlib.import_module("02_compute")
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument(
+    "-d",
+    "--data_dir",
+    type=str,
+    help="Data dir",
+)
+parser.add_argument("-c",
+                    "--conference",
+                    type=str,
+                    choices=scc_lib.Conference.ALL,
+                    help="conference_year, e.g. iclr_2022",
+                    required=True)
+parser.add_argument('-r',
+                    '--record_directory',
+                    default='./records/',
+                    type=str,
+                    help='prefix for tsv file with status of all forums')
+parser.add_argument('-l',
+                    '--layout',
+                    default=None,
+                    type=str,
+                    choices=scc_storage_lib.Layout.ALL,
+                    help='storage layout (default: detect)')
+parser.add_argument('--download_workers',
+                    default=4,
+                    type=int,
+                    help='threads downloading from OpenReview')
+parser.add_argument('--extract_workers',
+                    default=4,
+                    type=int,
+                    help='threads running pdftotext')
+parser.add_argument('--compute_workers',
+                    default=multiprocessing.cpu_count(),
+                    type=int,
+                    help='processes tokenizing and diffing')
+parser.add_argument('-q',
+                    '--queue_size',
+                    default=16,
+                    type=int,
+                    help='maximum number of forums waiting between stages')
+compute_stage.add_diff_arguments(parser)
+scc_lib.add_shard_arguments(parser)
+
+_DONE = None  # Queue sentinel
+
+
+class RecordWriter(object):
+    """Appends the records of one stage, from any thread."""
+
+    def __init__(self, filename):
+        self.file_handle = open(filename, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            scc_lib.write_record(record, self.file_handle)
+
+    def close(self):
+        self.file_handle.close()
+
+
+def report_error(stage, forum_id, e):
+    # No record is written, so the forum is retried when resuming
+    print(f'{stage} failed for {forum_id}:')
+    traceback.print_exception(e)
+
+
+def download_worker(download_queue, extract_queue, storage, conference,
+                    writer, extract_shard):
+    while True:
+        forum = download_queue.get()
+        if forum is _DONE:
+            break
+        try:
+            record = download_stage.download_forum(forum, conference, storage)
+        except Exception as e:
+            report_error(scc_lib.Stage.DOWNLOAD, forum.id, e)
+            continue
+        writer.write(record)
+        if (record.status == scc_lib.DownloadStatus.COMPLETE
+                and extract_shard.owns(forum.id)):
+            extract_queue.put(forum.id)
+
+
+def extract_worker(extract_queue, compute_queue, storage, conference,
+                   writer, compute_shard):
+    while True:
+        forum_id = extract_queue.get()
+        if forum_id is _DONE:
+            break
+        try:
+            record, paper = extract_stage.extract_forum(
+                storage, conference, forum_id)
+        except Exception as e:
+            report_error(scc_lib.Stage.EXTRACT, forum_id, e)
+            continue
+        writer.write(record)
+        if (record.status == scc_lib.ExtractionStatus.COMPLETE
+                and compute_shard.owns(forum_id)):
+            compute_queue.put((forum_id, paper))
+
+
+def compute_feeder(compute_queue, pool, max_in_flight, storage, conference,
+                   options, writer, progress):
+    """Hand forums to the process pool, with at most max_in_flight forums
+    submitted but not finished."""
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def on_result(records):
+        for record in records:
+            writer.write(record)
+        progress.update()
+        in_flight.release()
+
+    def on_error(forum_id):
+
+        def callback(e):
+            report_error(scc_lib.Stage.COMPUTE, forum_id, e)
+            in_flight.release()
+
+        return callback
+
+    while True:
+        item = compute_queue.get()
+        if item is _DONE:
+            break
+        forum_id, paper = item
+        in_flight.acquire()
+        pool.apply_async(compute_stage.compute_forum,
+                         (storage, conference, forum_id, options, paper),
+                         callback=on_result,
+                         error_callback=on_error(forum_id))
+    # Wait for the last forums
+    for _ in range(max_in_flight):
+        in_flight.acquire()
+
+
+def start_threads(num_threads, target, args):
+    threads = [
+        threading.Thread(target=target, args=args, daemon=True)
+        for _ in range(num_threads)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def main():
+    args = parser.parse_args()
+
+    conference = args.conference
+    storage = scc_storage_lib.open_storage(args.data_dir, conference,
+                                           args.layout)
+    options = compute_stage.get_diff_options(args)
+
+    def get_records(stage, complete_only=False):
+        return set(
+            scc_lib.get_records(args.record_directory,
+                                conference,
+                                stage,
+                                complete_only=complete_only))
+
+    downloaded = get_records(scc_lib.Stage.DOWNLOAD)
+    extracted = get_records(scc_lib.Stage.EXTRACT)
+    computed = get_records(scc_lib.Stage.COMPUTE)
+    # Forums whose earlier stages finished in a previous run
+    to_extract = get_records(scc_lib.Stage.DOWNLOAD,
+                             complete_only=True) - extracted
+    to_compute = get_records(scc_lib.Stage.EXTRACT,
+                             complete_only=True) - computed
+
+    # Fork the diffing processes before starting any threads
+    pool = multiprocessing.Pool(args.compute_workers)
+
+    shards = {
+        stage: scc_lib.get_work_shard(args, stage)
+        for stage in scc_lib.Stage.ALL
+    }
+    writers = {
+        stage: RecordWriter(shards[stage].record_filename(
+            args.record_directory))
+        for stage in scc_lib.Stage.ALL
+    }
+    download_queue = queue.Queue(args.queue_size)
+    extract_queue = queue.Queue(args.queue_size)
+    compute_queue = queue.Queue(args.queue_size)
+    progress = tqdm.tqdm(desc="computed")
+
+    compute_thread, = start_threads(
+        1, compute_feeder,
+        (compute_queue, pool, 2 * args.compute_workers, storage, conference,
+         options, writers[scc_lib.Stage.COMPUTE], progress))
+    extract_threads = start_threads(
+        args.extract_workers, extract_worker,
+        (extract_queue, compute_queue, storage, conference,
+         writers[scc_lib.Stage.EXTRACT], shards[scc_lib.Stage.COMPUTE]))
+    download_threads = start_threads(
+        args.download_workers, download_worker,
+        (download_queue, extract_queue, storage, conference,
+         writers[scc_lib.Stage.DOWNLOAD], shards[scc_lib.Stage.EXTRACT]))
+
+    for forum_id in sorted(to_compute):
+        if shards[scc_lib.Stage.COMPUTE].owns(forum_id):
+            compute_queue.put((forum_id, None))
+    for forum_id in sorted(to_extract):
+        if shards[scc_lib.Stage.EXTRACT].owns(forum_id):
+            extract_queue.put(forum_id)
+    for forum in download_stage.get_forum_notes(conference):
+        if (forum.id not in downloaded
+                and shards[scc_lib.Stage.DOWNLOAD].owns(forum.id)):
+            download_queue.put(forum)
+
+    # Shut down one stage after the other
+    for _ in download_threads:
+        download_queue.put(_DONE)
+    for thread in download_threads:
+        thread.join()
+    for _ in extract_threads:
+        extract_queue.put(_DONE)
+    for thread in extract_threads:
+        thread.join()
+    compute_queue.put(_DONE)
+    compute_thread.join()
+
+    pool.close()
+    pool.join()
+    progress.close()
+    for writer in writers.values():
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,21 +7,55 @@ be very localized, there are large unchanged subsequences.
 We first use get_matching_blocks from difflib (Python library) to find maximal
 unchanged subsequences. We invert this list to find non-matching blocks, then
 use Myers to describe the edirs within the non-matching blocks.
+
+On long documents with many repeated tokens, difflib can be slow. A patience
+diff engine, which anchors on tokens that occur exactly once in both
+sequences, can be selected instead (see MatchingEngine). Similarly, Myers can
+be replaced inside non-matching blocks by a bit-parallel LCS computation, which
+can handle much larger blocks, or by a divide-and-conquer (Hirschberg) version
+of it, which runs in linear space and has no size limit (see
+EditScriptEngine). Blocks are only lumped into a single diff when they are too
+large for the engine or when the engine runs out of time.
+
+In hierarchical mode, unchanged sentences are first aligned by exact match,
+then changed sentences are paired by similarity, and token-level diffs are only
+computed inside paired sentences. The sentence pairs are included in the
+output.
 """
 
+import bisect
 import collections
 import difflib
-import interval
+import io
+import itertools
 import json
 import myers
+import random
 import re
 import sys
+import time
 import tqdm
 
+import scc_store_lib
+
 MATCHING_BLOCK = "MatchingBlock"
 NONMATCHING_BLOCK = "NonMatchingBlock"
 MIN_MATCHING_BLOCK_LEN = 3
 MAX_LEN = 3000
+MAX_BITPARALLEL_LEN = 5 * MAX_LEN
+BLOCK_TIME_BUDGET = 10.0  # Seconds allowed for diffing one nonmatching block
+# Subproblems with at most this many LCS table cells are diffed directly
+HIRSCHBERG_BASE_CELLS = 1 << 22
+# Blocks whose token masks would take more bits than this are not diffed
+MAX_HIRSCHBERG_MASK_BITS = 1 << 30
+
+# Changed sentences are paired if the Dice coefficient of their tokens is
+# at least this high
+SENTENCE_SIMILARITY_THRESHOLD = 0.5
+# Larger gaps between unchanged sentences are not searched for pairs
+MAX_SENTENCE_PAIRING_CELLS = 250000
+
+VERIFICATION_SAMPLE_RATE = 0.05
 
 MatchingBlock = collections.namedtuple(MATCHING_BLOCK, "a b l".split())
 NonMatchingBlock = collections.namedtuple(NONMATCHING_BLOCK,
@@ -30,90 +64,659 @@ NonMatchingBlock = collections.namedtuple(NONMATCHING_BLOCK,
 Diff = collections.namedtuple(
     "Diff", "old_index new_index old_tokens new_tokens".split())
 
+# Indices of a changed sentence in the source and dest; None if the sentence
+# was added or removed.
+SentencePair = collections.namedtuple("SentencePair",
+                                      "old_sentence new_sentence".split())
+
+
+class MatchingEngine(object):
+    DIFFLIB = "difflib"
+    PATIENCE = "patience"
+    ALL = [DIFFLIB, PATIENCE]
+
+
+class EditScriptEngine(object):
+    MYERS = "myers"
+    BITPARALLEL = "bitparallel"
+    HIRSCHBERG = "hirschberg"
+    ALL = [MYERS, BITPARALLEL, HIRSCHBERG]
+
+
+class VerificationLevel(object):
+    OFF = "off"
+    SAMPLED = "sampled"  # Full verification of a random sample of documents
+    FULL = "full"
+    ALL = [OFF, SAMPLED, FULL]
+
+
+class BlockTimeout(Exception):
+    pass
+
+
+# == Bit-parallel LCS =========================================================
+
+
+def bitparallel_diff(a, b, deadline=None):
+    """Edit script from a to b in the format returned by myers.diff.
+
+    Tokens are interned to ids, and each row of the LCS table is stored as one
+    Python int whose bit i is 0 iff the LCS value increases at column i
+    (Hyyro's formulation of the Allison-Dix bit-vector algorithm). Rows are
+    computed in O(len(a) * len(b) / w) and the edit script is traced back
+    through the stored rows.
+
+    Raises BlockTimeout if time.monotonic() passes the deadline.
+    """
+    token_ids = {}
+    a_ids = [token_ids.setdefault(token, len(token_ids)) for token in a]
+    b_ids = [token_ids.get(token) for token in b]
+
+    match_masks = [0] * len(token_ids)
+    for i, token_id in enumerate(a_ids):
+        match_masks[token_id] |= 1 << i
+
+    all_ones = (1 << len(a)) - 1
+    rows = [all_ones]
+    v = all_ones
+    for j, token_id in enumerate(b_ids):
+        if token_id is not None:
+            u = v & match_masks[token_id]
+            v = ((v + u) | (v - u)) & all_ones
+        rows.append(v)
+        if deadline is not None and not j % 256 and time.monotonic(
+        ) > deadline:
+            raise BlockTimeout()
+
+    def lcs_len(j, i):
+        # LCS of a[:i] and b[:j]
+        return i - (rows[j] & ((1 << i) - 1)).bit_count()
+
+    reversed_script = []
+    i, j = len(a), len(b)
+    current = lcs_len(j, i)
+    while i or j:
+        if i and j and a_ids[i - 1] == b_ids[j - 1]:
+            reversed_script.append(('k', a[i - 1]))
+            i -= 1
+            j -= 1
+            current -= 1
+        elif j and lcs_len(j - 1, i) == current:
+            reversed_script.append(('i', b[j - 1]))
+            j -= 1
+        else:
+            reversed_script.append(('r', a[i - 1]))
+            i -= 1
+        if deadline is not None and not (i + j) % 256 and time.monotonic(
+        ) > deadline:
+            raise BlockTimeout()
+
+    return reversed_script[::-1]
+
+
+def _lcs_row(masks, shift, width, b_ids, deadline):
+    """LCS lengths of b_ids against each prefix of a window of a.
+
+    The window is the `width` bits of each mask starting at bit `shift`.
+    Returns a list whose i-th element is the LCS length for the first i
+    tokens of the window. Only one row is kept in memory, along with the
+    window masks of the distinct tokens of b_ids.
+    """
+    all_ones = (1 << width) - 1
+    v = all_ones
+    window_masks = {}
+    for j, token_id in enumerate(b_ids):
+        if token_id is not None:
+            window_mask = window_masks.get(token_id)
+            if window_mask is None:
+                window_mask = (masks[token_id] >> shift) & all_ones
+                window_masks[token_id] = window_mask
+            u = v & window_mask
+            v = ((v + u) | (v - u)) & all_ones
+        if deadline is not None and not j % 256 and time.monotonic(
+        ) > deadline:
+            raise BlockTimeout()
+    bits = format(v, f'0{width}b')[::-1] if width else ""
+    return list(itertools.accumulate((c == '0' for c in bits), initial=0))
+
+
+def _hirschberg(a, b, a_ids, b_ids, a_lo, a_hi, b_lo, b_hi, forward_masks,
+                reverse_masks, deadline, script):
+    width = a_hi - a_lo
+    if width * (b_hi - b_lo) <= HIRSCHBERG_BASE_CELLS or b_hi - b_lo < 2:
+        script += bitparallel_diff(a[a_lo:a_hi], b[b_lo:b_hi], deadline)
+        return
+
+    # Split b in half, and find the split of a that lies on an optimal path
+    b_mid = (b_lo + b_hi) // 2
+    forward = _lcs_row(forward_masks, a_lo, width, b_ids[b_lo:b_mid],
+                       deadline)
+    backward = _lcs_row(reverse_masks,
+                        len(a) - a_hi, width, b_ids[b_mid:b_hi][::-1],
+                        deadline)
+    a_mid = a_lo + max(range(width + 1),
+                       key=lambda i: forward[i] + backward[width - i])
+
+    _hirschberg(a, b, a_ids, b_ids, a_lo, a_mid, b_lo, b_mid, forward_masks,
+                reverse_masks, deadline, script)
+    _hirschberg(a, b, a_ids, b_ids, a_mid, a_hi, b_mid, b_hi, forward_masks,
+                reverse_masks, deadline, script)
+
+
+def hirschberg_diff(a, b, deadline=None):
+    """Edit script from a to b in the format returned by myers.diff.
+
+    Divide-and-conquer over bit-parallel LCS rows, so that no quadratic LCS
+    table is kept, apart from subproblems of at most HIRSCHBERG_BASE_CELLS
+    cells, which are handed to bitparallel_diff. The match masks take one
+    len(a)-bit int per distinct token of a (twice, forward and reverse), so
+    memory is O(len(a) * distinct tokens) bits; returns None if that would
+    exceed MAX_HIRSCHBERG_MASK_BITS.
+
+    Raises BlockTimeout if time.monotonic() passes the deadline.
+    """
+    token_ids = {}
+    a_ids = [token_ids.setdefault(token, len(token_ids)) for token in a]
+    if 2 * len(token_ids) * len(a) > MAX_HIRSCHBERG_MASK_BITS:
+        return None
+    b_ids = [token_ids.get(token) for token in b]
+
+    # Bit i of forward_masks[t] (bit len(a) - 1 - i of reverse_masks[t]) is
+    # set iff a[i] has id t.
+    forward_masks = [0] * len(token_ids)
+    reverse_masks = [0] * len(token_ids)
+    for i, token_id in enumerate(a_ids):
+        forward_masks[token_id] |= 1 << i
+        reverse_masks[token_id] |= 1 << (len(a) - 1 - i)
+
+    script = []
+    _hirschberg(a, b, a_ids, b_ids, 0, len(a), 0, len(b), forward_masks,
+                reverse_masks, deadline, script)
+    return script
+
+
+# == Patience matching ========================================================
+
+
+def _longest_increasing_anchors(anchors):
+    """Longest subsequence of (a, b) anchors (sorted by a) increasing in b.
+
+    Patience sorting, O(k log k) in the number of anchors.
+    """
+    pile_tops = []  # b value at the top of each pile
+    pile_anchor_indices = []
+    backpointers = []
+    for i, (_, b) in enumerate(anchors):
+        pile = bisect.bisect_left(pile_tops, b)
+        backpointers.append(pile_anchor_indices[pile - 1] if pile else None)
+        if pile == len(pile_tops):
+            pile_tops.append(b)
+            pile_anchor_indices.append(i)
+        else:
+            pile_tops[pile] = b
+            pile_anchor_indices[pile] = i
+
+    lis = []
+    i = pile_anchor_indices[-1] if pile_anchor_indices else None
+    while i is not None:
+        lis.append(anchors[i])
+        i = backpointers[i]
+    return lis[::-1]
+
+
+def _unique_anchors(a, b, alo, ahi, blo, bhi):
+    """Pairs of positions of tokens occurring exactly once in both regions."""
+    a_counts = collections.Counter(a[alo:ahi])
+    b_positions = {}
+    for j in range(blo, bhi):
+        token = b[j]
+        if a_counts[token] == 1:
+            b_positions[token] = None if token in b_positions else j
+    return [(i, b_positions[a[i]]) for i in range(alo, ahi)
+            if b_positions.get(a[i]) is not None]
+
+
+def patience_matching_blocks(a, b):
+    """Drop-in replacement for SequenceMatcher(None, a, b).get_matching_blocks.
+
+    Tokens which occur exactly once in both sequences are used as anchors;
+    the longest increasing run of anchors is extended into maximal matches and
+    the gaps between them are processed recursively. Gaps without unique
+    tokens fall back to difflib (without autojunk), which is cheap because
+    such gaps are short.
+    """
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = regions.pop()
+
+        # Common prefix and suffix
+        prefix = 0
+        while (alo + prefix < ahi and blo + prefix < bhi
+               and a[alo + prefix] == b[blo + prefix]):
+            prefix += 1
+        if prefix:
+            matches.append((alo, blo, prefix))
+            alo += prefix
+            blo += prefix
+        suffix = 0
+        while (ahi - suffix > alo and bhi - suffix > blo
+               and a[ahi - suffix - 1] == b[bhi - suffix - 1]):
+            suffix += 1
+        if suffix:
+            matches.append((ahi - suffix, bhi - suffix, suffix))
+            ahi -= suffix
+            bhi -= suffix
+
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = _longest_increasing_anchors(
+            _unique_anchors(a, b, alo, ahi, blo, bhi))
+        if not anchors:
+            for match in difflib.SequenceMatcher(
+                    None, a[alo:ahi], b[blo:bhi],
+                    autojunk=False).get_matching_blocks():
+                if match.size:
+                    matches.append(
+                        (alo + match.a, blo + match.b, match.size))
+            continue
+
+        # Extend each anchor into a maximal match within the current region,
+        # then queue up the gaps between consecutive matches.
+        a_cursor, b_cursor = alo, blo
+        for i, j in anchors:
+            if i < a_cursor or j < b_cursor:  # Inside the previous match
+                continue
+            start_i, start_j = i, j
+            while (start_i > a_cursor and start_j > b_cursor
+                   and a[start_i - 1] == b[start_j - 1]):
+                start_i -= 1
+                start_j -= 1
+            end_i, end_j = i + 1, j + 1
+            while end_i < ahi and end_j < bhi and a[end_i] == b[end_j]:
+                end_i += 1
+                end_j += 1
+            regions.append((a_cursor, start_i, b_cursor, start_j))
+            matches.append((start_i, start_j, end_i - start_i))
+            a_cursor, b_cursor = end_i, end_j
+        regions.append((a_cursor, ahi, b_cursor, bhi))
+
+    # Merge adjacent matches so that blocks are maximal, as in difflib
+    matches.sort()
+    merged = []
+    for i, j, size in matches:
+        if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][
+                1] + merged[-1][2] == j:
+            merged[-1][2] += size
+        else:
+            merged.append([i, j, size])
 
-def flatten_sentences(sentences):
-    return sum(sentences, [])
+    return [difflib.Match(i, j, size) for i, j, size in merged
+            ] + [difflib.Match(len(a), len(b), 0)]
 
 
-def compute_ranges(unflat_sentences):
-    cursor = 0
-    ranges = []
-    for sent in unflat_sentences:
-        end = cursor + len(sent)
-        ranges.append(interval.Interval(cursor, end))
-        cursor = end
-    return ranges
+def flatten_sentences(sentences):
+    return list(itertools.chain.from_iterable(sentences))
 
 
-EMPTY_INTERVAL = interval.Interval(0, 0)
+def sentence_split(anchor, tokens, offsets, original_tokens):
+    start = anchor + 1
+    split_tokens = scc_store_lib.split_into_sentences(original_tokens, start,
+                                                      start + len(tokens),
+                                                      offsets)
+    assert flatten_sentences(split_tokens) == tokens
+    return split_tokens
 
 
-def sentence_split(anchor, tokens, ranges, original_tokens):
-    target_range = interval.Interval(anchor + 1, anchor + 1 + len(tokens))
-    diff_ranges = []
-    for r in ranges:
-        if r == target_range:
-            diff_ranges.append(r)
+# == Sentence pairing =========================================================
+
+
+def sentence_similarity(source_counts, dest_counts):
+    """Dice coefficient of two sentences' token multisets (as Counters)."""
+    total = sum(source_counts.values()) + sum(dest_counts.values())
+    if not total:
+        return 1.0
+    return 2 * sum((source_counts & dest_counts).values()) / total
+
+
+def pair_similar_sentences(source_sentences, dest_sentences):
+    """Monotone pairing of sentences maximizing total similarity.
+
+    Only pairs with similarity at least SENTENCE_SIMILARITY_THRESHOLD are
+    considered. Returns (source index, dest index) pairs in order.
+    """
+    n, m = len(source_sentences), len(dest_sentences)
+    if not n or not m or n * m > MAX_SENTENCE_PAIRING_CELLS:
+        return []
+
+    dest_counts = [collections.Counter(s) for s in dest_sentences]
+    scores = [[0.0] * (m + 1)]
+    pair_scores = []
+    for i, source_sentence in enumerate(source_sentences):
+        source_counts = collections.Counter(source_sentence)
+        similarities = [
+            sentence_similarity(source_counts, counts)
+            for counts in dest_counts
+        ]
+        pair_scores.append(similarities)
+        row = [0.0]
+        for j, similarity in enumerate(similarities):
+            best = max(scores[i][j + 1], row[j])
+            if similarity >= SENTENCE_SIMILARITY_THRESHOLD:
+                best = max(best, scores[i][j] + similarity)
+            row.append(best)
+        scores.append(row)
+
+    pairs = []
+    i, j = n, m
+    while i and j:
+        if scores[i][j] == scores[i - 1][j]:
+            i -= 1
+        elif scores[i][j] == scores[i][j - 1]:
+            j -= 1
         else:
-            maybe_intersection = r & target_range
-            if maybe_intersection == EMPTY_INTERVAL:
-                continue
-            diff_ranges.append(maybe_intersection)
-    split_tokens = []
-    for r in diff_ranges:
-        maybe_tokens  = original_tokens[r.lower_bound:r.upper_bound]
-        if maybe_tokens:
-            split_tokens.append(maybe_tokens)
-
-    assert sum(split_tokens, []) == tokens
-    return split_tokens
+            pairs.append((i - 1, j - 1))
+            i -= 1
+            j -= 1
+    return pairs[::-1]
+
+
+def get_edit_script(source_block_tokens, dest_block_tokens,
+                    edit_script_engine):
+    """Get edit script for a nonmatching block.
+
+    Returns None if the block is too large for the engine, or if the engine
+    ran out of time.
+    """
+    block_len = len(source_block_tokens) + len(dest_block_tokens)
+    if edit_script_engine == EditScriptEngine.BITPARALLEL:
+        if block_len <= MAX_BITPARALLEL_LEN:
+            try:
+                return bitparallel_diff(source_block_tokens,
+                                        dest_block_tokens,
+                                        deadline=time.monotonic() +
+                                        BLOCK_TIME_BUDGET)
+            except BlockTimeout:
+                pass
+    elif edit_script_engine == EditScriptEngine.HIRSCHBERG:
+        try:
+            return hirschberg_diff(source_block_tokens,
+                                   dest_block_tokens,
+                                   deadline=time.monotonic() +
+                                   BLOCK_TIME_BUDGET)
+        except BlockTimeout:
+            pass
+    else:
+        assert edit_script_engine == EditScriptEngine.MYERS
+        if block_len <= MAX_LEN:
+            return myers.diff(source_block_tokens, dest_block_tokens)
+    return None
+
+
+def keep_long_runs(alignment, min_len=MIN_MATCHING_BLOCK_LEN):
+    """Unalign tokens that are not in a run of more than min_len tokens
+    aligned to consecutive dest tokens, as short matching blocks are dropped
+    when diffing directly."""
+    alignment = list(alignment)
+    run_start = 0
+    for i in range(len(alignment) + 1):
+        if (i < len(alignment) and i > run_start
+                and alignment[i - 1] != -1
+                and alignment[i] == alignment[i - 1] + 1):
+            continue
+        # The run of alignment[run_start:i] ended
+        if i - run_start <= min_len:
+            alignment[run_start:i] = [-1] * (i - run_start)
+        run_start = i
+    return alignment
+
+
+def align_gaps(alignment, source_tokens, dest_tokens, edit_script_engine):
+    """Align tokens within the gaps between aligned tokens, by diffing each
+    gap with the edit script engine.
+
+    Returns the new alignment and the number of gaps that were too large to
+    diff.
+    """
+    alignment = list(alignment)
+    num_lumped = 0
+    prev_source_index, prev_dest_index = -1, -1
+    aligned_pairs = itertools.chain(
+        [(i, j) for i, j in enumerate(alignment) if j != -1],
+        [(len(source_tokens), len(dest_tokens))])
+    for source_index, dest_index in aligned_pairs:
+        if (source_index > prev_source_index + 1
+                and dest_index > prev_dest_index + 1):
+            edit_script = get_edit_script(
+                source_tokens[prev_source_index + 1:source_index],
+                dest_tokens[prev_dest_index + 1:dest_index],
+                edit_script_engine)
+            if edit_script is None:
+                num_lumped += 1
+            else:
+                i, j = prev_source_index + 1, prev_dest_index + 1
+                for action, _ in edit_script:
+                    if action == 'k':
+                        alignment[i] = j
+                    if action in 'kr':
+                        i += 1
+                    if action in 'ki':
+                        j += 1
+        prev_source_index, prev_dest_index = source_index, dest_index
+    return alignment, num_lumped
+
+
+def alignment_to_chunk_diffs(alignment, source_tokens, dest_tokens):
+    """Chunk diffs covering the gaps between aligned (kept) tokens.
+
+    Each diff is anchored at the preceding aligned pair, or at (-1, -1).
+    """
+    chunk_diffs = []
+    prev_source_index, prev_dest_index = -1, -1
+    aligned_pairs = itertools.chain(
+        ((i, j) for i, j in enumerate(alignment) if j != -1),
+        [(len(source_tokens), len(dest_tokens))])
+    for source_index, dest_index in aligned_pairs:
+        if (source_index > prev_source_index + 1
+                or dest_index > prev_dest_index + 1):
+            chunk_diffs.append(
+                Diff(prev_source_index, prev_dest_index,
+                     source_tokens[prev_source_index + 1:source_index],
+                     dest_tokens[prev_dest_index + 1:dest_index]))
+        prev_source_index, prev_dest_index = source_index, dest_index
+    return chunk_diffs
 
 
 class DocumentDiff(object):
 
-    def __init__(self, unflat_source_tokens, unflat_dest_tokens):
+    def __init__(self,
+                 unflat_source_tokens,
+                 unflat_dest_tokens,
+                 matching_engine=MatchingEngine.DIFFLIB,
+                 edit_script_engine=EditScriptEngine.MYERS,
+                 verification_level=VerificationLevel.FULL,
+                 alignment=None,
+                 hierarchical=False):
         # Saving these, but they are only used for output
         self.source_unflat = unflat_source_tokens
         self.dest_unflat = unflat_dest_tokens
 
-        self.source_ranges = compute_ranges(self.source_unflat)
-        self.dest_ranges = compute_ranges(self.dest_unflat)
+        self.source_offsets = scc_store_lib.get_sentence_offsets(
+            self.source_unflat)
+        self.dest_offsets = scc_store_lib.get_sentence_offsets(
+            self.dest_unflat)
 
         self.source_tokens = flatten_sentences(unflat_source_tokens)
         self.dest_tokens = flatten_sentences(unflat_dest_tokens)
 
+        self.matching_engine = matching_engine
+        self.edit_script_engine = edit_script_engine
+        self.hierarchical = hierarchical
+        self.sentence_pairs = None  # Only computed in hierarchical mode
+        self.categories = None  # (type, scope) per diff, if categorized
+
+        if verification_level == VerificationLevel.SAMPLED:
+            # Fully verify a random fraction of documents, skip the rest
+            if random.random() < VERIFICATION_SAMPLE_RATE:
+                verification_level = VerificationLevel.FULL
+            else:
+                verification_level = VerificationLevel.OFF
+        self.verification_level = verification_level
+
         self.error = None
-        self.calculate()
+        self.lumped_blocks = 0  # Nonmatching blocks that were not diffed
+        self.calculate(alignment)
 
-    def calculate(self):
+    def calculate(self, alignment=None):
 
-        # Get matching and nonmatching blocks, then verify block calculation
-        blocks = self._get_matching_blocks()
+        if alignment is None and self.hierarchical:
+            alignment = self._get_sentence_alignment()
 
-        # Verify block calculation
-        self._reconstruct_from_blocks(blocks)
+        if alignment is None:
+            # Get matching and nonmatching blocks, then verify block
+            # calculation
+            blocks = self._get_matching_blocks()
 
-        # Blocks to chunk diffs
-        chunk_diffs = []
-        for block in blocks:
-            if isinstance(block, NonMatchingBlock):
-                chunk_diffs += self._block_to_chunk_diffs(block)
+            # Verify block calculation
+            self._reconstruct_from_blocks(blocks)
+
+            # Blocks to chunk diffs
+            chunk_diffs = []
+            for block in blocks:
+                if isinstance(block, NonMatchingBlock):
+                    chunk_diffs += self._block_to_chunk_diffs(block)
+            del blocks  # Intermediate structures are dropped early
+        else:
+            # The token alignment is already known (e.g. from composing two
+            # diffs); the chunk diffs are the gaps between aligned tokens.
+            chunk_diffs = alignment_to_chunk_diffs(alignment,
+                                                   self.source_tokens,
+                                                   self.dest_tokens)
 
         # Verify chunk diff calculations
         self._reconstruct_from_chunk_diffs(chunk_diffs)
 
-        self.diffs = []
-        for chunk_diff in chunk_diffs:
-            self.diffs.append(self._unchunk_chunk_diff(chunk_diff))
+        self.diffs = [
+            self._unchunk_chunk_diff(chunk_diff) for chunk_diff in chunk_diffs
+        ]
+        del chunk_diffs
 
         # Verify chunk diff calculations
         self._reconstruct_from_diffs()
 
+    def _get_sentence_alignment(self):
+        """Align tokens sentence by sentence, and record sentence pairs.
+
+        Identical sentences are aligned first, by matching sentence ids.
+        Within each gap between runs of identical sentences, similar
+        sentences are paired and token-level diffs are computed within pairs.
+        """
+        sentence_ids = {}
+        source_ids = [
+            sentence_ids.setdefault(tuple(s), len(sentence_ids))
+            for s in self.source_unflat
+        ]
+        dest_ids = [
+            sentence_ids.setdefault(tuple(s), len(sentence_ids))
+            for s in self.dest_unflat
+        ]
+        if self.matching_engine == MatchingEngine.PATIENCE:
+            sentence_blocks = patience_matching_blocks(source_ids, dest_ids)
+        else:
+            sentence_blocks = difflib.SequenceMatcher(
+                None, source_ids, dest_ids,
+                autojunk=False).get_matching_blocks()
+
+        alignment = [-1] * len(self.source_tokens)
+        self.sentence_pairs = []
+        source_cursor = 0
+        dest_cursor = 0
+        for block in sentence_blocks:
+            # Changed sentences between the previous block and this one
+            gap_pairs = pair_similar_sentences(
+                self.source_unflat[source_cursor:block.a],
+                self.dest_unflat[dest_cursor:block.b])
+            gap_source_start, gap_dest_start = source_cursor, dest_cursor
+            for i, j in gap_pairs:
+                i += gap_source_start
+                j += gap_dest_start
+                self._add_unpaired_sentences(source_cursor, i, dest_cursor, j)
+                if self.source_unflat[i] != self.dest_unflat[j]:
+                    self.sentence_pairs.append(SentencePair(i, j))
+                self._align_sentence_pair(i, j, alignment)
+                source_cursor, dest_cursor = i + 1, j + 1
+            self._add_unpaired_sentences(source_cursor, block.a, dest_cursor,
+                                         block.b)
+
+            # Identical sentences
+            for k in range(block.size):
+                source_start = self.source_offsets[block.a + k]
+                dest_start = self.dest_offsets[block.b + k]
+                for t in range(len(self.source_unflat[block.a + k])):
+                    alignment[source_start + t] = dest_start + t
+            source_cursor = block.a + block.size
+            dest_cursor = block.b + block.size
+
+        return alignment
+
+    def _add_unpaired_sentences(self, source_start, source_end, dest_start,
+                                dest_end):
+        self.sentence_pairs += [
+            SentencePair(i, None) for i in range(source_start, source_end)
+        ]
+        self.sentence_pairs += [
+            SentencePair(None, j) for j in range(dest_start, dest_end)
+        ]
+
+    def _align_sentence_pair(self, i, j, alignment):
+        edit_script = self._get_edit_script(self.source_unflat[i],
+                                            self.dest_unflat[j])
+        if edit_script is None:
+            self.lumped_blocks += 1
+            return
+        source_index = self.source_offsets[i]
+        dest_index = self.dest_offsets[j]
+        for action, _ in edit_script:
+            if action == 'k':
+                alignment[source_index] = dest_index
+            if action in 'kr':
+                source_index += 1
+            if action in 'ki':
+                dest_index += 1
+
+    def get_alignment(self):
+        """For each source token, the index of the dest token it is kept as.
+
+        Removed source tokens are aligned to -1.
+        """
+        alignment = []
+        source_cursor = 0
+        dest_cursor = 0
+        for diff in self.diffs:
+            alignment += range(
+                dest_cursor, dest_cursor + diff.old_index + 1 - source_cursor)
+            old_len = sum(len(old_string) for old_string in diff.old_tokens)
+            new_len = sum(len(new_string) for new_string in diff.new_tokens)
+            alignment += [-1] * old_len
+            source_cursor = diff.old_index + 1 + old_len
+            dest_cursor = diff.new_index + 1 + new_len
+        alignment += range(
+            dest_cursor,
+            dest_cursor + len(self.source_tokens) - source_cursor)
+        return alignment
+
     def _get_matching_blocks(self):
         """Get maximal matching blocks and calculate nonmatching blocks.
         """
-        unfiltered_matching_blocks = difflib.SequenceMatcher(
-            None, self.source_tokens, self.dest_tokens).get_matching_blocks()
+        if self.matching_engine == MatchingEngine.PATIENCE:
+            unfiltered_matching_blocks = patience_matching_blocks(
+                self.source_tokens, self.dest_tokens)
+        else:
+            assert self.matching_engine == MatchingEngine.DIFFLIB
+            unfiltered_matching_blocks = difflib.SequenceMatcher(
+                None, self.source_tokens,
+                self.dest_tokens).get_matching_blocks()
 
         matching_blocks = [b for b in unfiltered_matching_blocks if not b.size
         or b.size > MIN_MATCHING_BLOCK_LEN]
@@ -148,24 +751,30 @@ class DocumentDiff(object):
 
         return blocks
 
+    def _get_edit_script(self, source_block_tokens, dest_block_tokens):
+        return get_edit_script(source_block_tokens, dest_block_tokens,
+                               self.edit_script_engine)
+
     def _block_to_chunk_diffs(self, block):
         """Convert nonmatching block into a diff."""
 
-        if block.l_b + block.l_a > MAX_LEN:
+        source_block_tokens = self.source_tokens[block.a:block.a + block.l_a]
+        dest_block_tokens = self.dest_tokens[block.b:block.b + block.l_b]
+
+        myers_diff = self._get_edit_script(source_block_tokens,
+                                           dest_block_tokens)
+
+        if myers_diff is None:
             print(f"Skipped large block")
+            self.lumped_blocks += 1
             # This diff adds many characters. It's likely to be something like
             # an appendix being added. We just convert the block into one large
             # diff.
             return [
-                Diff(block.a - 1, block.b - 1,
-                      self.source_tokens[block.a:block.a + block.l_a],
-                      self.dest_tokens[block.b:block.b + block.l_b])
+                Diff(block.a - 1, block.b - 1, source_block_tokens,
+                     dest_block_tokens)
             ]
 
-        myers_diff = myers.diff(
-            self.source_tokens[block.a:block.a + block.l_a],
-            self.dest_tokens[block.b:block.b + block.l_b])
-
         # In our method of diff naming, each diff needs to be anchored to an
         # index in the source sequence. The anchors are collected below.
         indexed_myers_diff = []
@@ -207,77 +816,154 @@ class DocumentDiff(object):
     def _unchunk_chunk_diff(self, chunk_diff):
         unchunked_old = sentence_split(chunk_diff.old_index,
                                        chunk_diff.old_tokens,
-                                       self.source_ranges, self.source_tokens)
+                                       self.source_offsets, self.source_tokens)
         unchunked_new = sentence_split(chunk_diff.new_index,
-                                       chunk_diff.new_tokens, self.dest_ranges,
-                                       self.dest_tokens)
+                                       chunk_diff.new_tokens,
+                                       self.dest_offsets, self.dest_tokens)
         return Diff(chunk_diff.old_index, chunk_diff.new_index, unchunked_old,
                      unchunked_new)
 
+    def write(self, file_handle):
+        """Write the diff as JSON to file_handle piece by piece.
+
+        Each sentence and each diff is serialized separately, on its own line,
+        so the whole document is never held in memory as one string.
+        """
+        if self.error is not None:
+            return
+
+        def write_list(items, indent):
+            if not items:
+                file_handle.write("[]")
+                return
+            file_handle.write("[")
+            for i, item in enumerate(items):
+                file_handle.write(("," if i else "") + "\n" + " " * indent +
+                                  json.dumps(item))
+            file_handle.write("\n" + " " * (indent - 2) + "]")
+
+        file_handle.write('{\n  "tokens": {\n    "source": ')
+        write_list(self.source_unflat, 6)
+        file_handle.write(',\n    "dest": ')
+        write_list(self.dest_unflat, 6)
+        file_handle.write('\n  },\n  "diffs": ')
+        write_list([d._asdict() for d in self.diffs], 4)
+        file_handle.write(',\n  "alignment": ' +
+                          json.dumps(self.get_alignment()))
+        if self.categories is not None:
+            file_handle.write(',\n  "categories": ')
+            write_list(self.categories, 4)
+        if self.sentence_pairs is not None:
+            file_handle.write(',\n  "sentence_pairs": ')
+            write_list([p._asdict() for p in self.sentence_pairs], 4)
+        file_handle.write("\n}")
+
     def dump(self):
-        if self.error is None:
-            return json.dumps(
-                {
-                    "tokens": {
-                        "source": self.source_unflat,
-                        "dest": self.dest_unflat
-                    },
-                    "diffs": [d._asdict() for d in self.diffs]
-                },
-                indent=2)
-        else:
-            return ""
+        string_buffer = io.StringIO()
+        self.write(string_buffer)
+        return string_buffer.getvalue()
 
     # ======= Reconstruction methods below ====================================
-    # These methods are used to check for bugs in the diff logic.
+    # These methods are used to check for bugs in the diff logic. Each one
+    # describes the reconstructed destination as a sequence of (tokens, start,
+    # end) segments, which are concatenated and compared against the
+    # destination tokens unless verification is off.
 
-    def _reconstruct_from_blocks(self, blocks):
+    def _matches_dest(self, segments):
+        assert self.verification_level == VerificationLevel.FULL
         reconstructed_tokens = []
+        for tokens, start, end in segments:
+            reconstructed_tokens += tokens[start:end]
+        return reconstructed_tokens == self.dest_tokens
+
+    def _reconstruct_from_blocks(self, blocks):
+        if self.verification_level == VerificationLevel.OFF:
+            return
+        segments = []
         for block in blocks:
             if isinstance(block, MatchingBlock):
-                reconstructed_tokens += self.source_tokens[block.a:block.a +
-                                                           block.l]
+                segments.append(
+                    (self.source_tokens, block.a, block.a + block.l))
             else:
                 assert isinstance(block, NonMatchingBlock)
                 if block.l_b:
-                    reconstructed_tokens += self.dest_tokens[block.b:block.b +
-                                                             block.l_b]
+                    segments.append(
+                        (self.dest_tokens, block.b, block.b + block.l_b))
 
-        assert reconstructed_tokens == self.dest_tokens
+        assert self._matches_dest(segments)
 
     def _reconstruct_from_chunk_diffs(self, chunk_diffs):
-        reconstructed_tokens = []
+        if self.verification_level == VerificationLevel.OFF:
+            return
+        segments = []
         source_cursor = 0
         for i, diff in enumerate(chunk_diffs):
-            reconstructed_tokens += self.source_tokens[source_cursor:diff.
-                                                       old_index + 1]
-            reconstructed_tokens += diff.new_tokens
+            segments.append(
+                (self.source_tokens, source_cursor, diff.old_index + 1))
+            segments.append((diff.new_tokens, 0, len(diff.new_tokens)))
             source_cursor = diff.old_index + 1 + len(diff.old_tokens)
 
             assert ((diff.old_index == diff.new_index == -1)
                     or self.source_tokens[diff.old_index]
                     == self.dest_tokens[diff.new_index])
 
-        reconstructed_tokens += self.source_tokens[source_cursor:]
+        segments.append(
+            (self.source_tokens, source_cursor, len(self.source_tokens)))
 
-        if not reconstructed_tokens == self.dest_tokens:
+        if not self._matches_dest(segments):
             self.error = "chunk_reconstruction_error"
 
     def _reconstruct_from_diffs(self):
-        reconstructed_tokens = []
+        if self.verification_level == VerificationLevel.OFF:
+            return
+        segments = []
         source_cursor = 0
         for i, diff in enumerate(self.diffs):
-            reconstructed_tokens += self.source_tokens[source_cursor:diff.
-                                                       old_index + 1]
+            segments.append(
+                (self.source_tokens, source_cursor, diff.old_index + 1))
             for new_string in diff.new_tokens:
-                reconstructed_tokens += new_string
+                segments.append((new_string, 0, len(new_string)))
 
             source_cursor = diff.old_index + 1
             for old_string in diff.old_tokens:
                 source_cursor += len(old_string)
 
-        reconstructed_tokens += self.source_tokens[source_cursor:]
+        segments.append(
+            (self.source_tokens, source_cursor, len(self.source_tokens)))
 
-        if not reconstructed_tokens == self.dest_tokens:
+        if not self._matches_dest(segments):
             self.error = "reconstruction_error"
 
+
+def compose(first,
+            second,
+            edit_script_engine=EditScriptEngine.MYERS,
+            verification_level=VerificationLevel.FULL):
+    """Diff from first's source to second's dest, where first's dest is
+    second's source.
+
+    Runs of tokens kept by both diffs serve as matching blocks, if they are
+    long enough to be kept by a direct diff. The gaps between them are diffed
+    with the edit script engine, which restores tokens removed by first and
+    put back by second. Gaps are small compared to the document, so this is
+    much cheaper than a direct diff. The result goes through the same
+    reconstruction checks as a directly computed diff, and lumped_blocks
+    counts the gaps that were too large to diff.
+    """
+    assert first.dest_tokens == second.source_tokens
+    second_alignment = second.get_alignment()
+    kept_by_both = [
+        -1 if dest_index == -1 else second_alignment[dest_index]
+        for dest_index in first.get_alignment()
+    ]
+    alignment, lumped_blocks = align_gaps(keep_long_runs(kept_by_both),
+                                          first.source_tokens,
+                                          second.dest_tokens,
+                                          edit_script_engine)
+    d = DocumentDiff(first.source_unflat,
+                     second.dest_unflat,
+                     edit_script_engine=edit_script_engine,
+                     verification_level=verification_level,
+                     alignment=alignment)
+    d.lumped_blocks = lumped_blocks
+    return d
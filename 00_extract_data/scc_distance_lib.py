@@ -0,0 +1 @@
+../scc_distance_lib.py
\ No newline at end of file
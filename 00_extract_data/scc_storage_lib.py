@@ -0,0 +1 @@
+../scc_storage_lib.py
\ No newline at end of file
@@ -0,0 +1 @@
+../scc_store_lib.py
\ No newline at end of file
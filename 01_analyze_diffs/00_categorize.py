@@ -3,7 +3,6 @@
 
 import argparse
 import collections
-import json
 import tqdm
 
 import scc_lib
@@ -17,17 +16,44 @@ parser.add_argument('-r',
                     default=('/work/pi_mccallum_umass_edu/nnayak_umass_edu/'
                              'latourian_modality/00_extract_data/records/'),
                     type=str)
-
-
-def count_categories(filename):
-    with open(filename, 'r') as f:
-        obj = json.load(f)
-
-    sentence_ranges = scc_lib.compute_sentence_ranges(obj['tokens']['source'])
-    return collections.Counter([
-        scc_lib.get_diff_type_and_scope(d, sentence_ranges)
-        for d in obj['diffs']
-    ])
+parser.add_argument('--from_records',
+                    action='store_true',
+                    help=('use category counts stored in compute records '
+                          '(02_compute.py --categorize) instead of diff '
+                          'files'))
+parser.add_argument('--from_table',
+                    type=str,
+                    default=None,
+                    help=('count categories in the diff table written by '
+                          '03_export_diff_table.py instead of diff files'))
+
+
+def count_categories(section):
+    obj = scc_lib.load_section(section)
+    return collections.Counter(
+        category for category in scc_lib.get_document_categories(obj)
+        if category != (None, None))
+
+
+def count_categories_from_records(record_directory, conference, section):
+    diff_categories = collections.Counter()
+    for record in scc_lib.get_records(record_directory,
+                                      conference,
+                                      scc_lib.Stage.COMPUTE,
+                                      complete_only=True,
+                                      full_records=True):
+        if record['part'] == section and record.get('categories'):
+            for d_type, scope_counts in record['categories'].items():
+                for d_scope, count in scope_counts.items():
+                    diff_categories[d_type, d_scope] += count
+    return diff_categories
+
+
+def count_categories_from_table(table_directory):
+    columns = ["conference", "part", "diff_type", "diff_scope"]
+    table = pd.read_parquet(table_directory, columns=columns)
+    # Partition columns are read back as categoricals
+    return table.groupby(columns, observed=True).size()
 
 
 def main():
@@ -35,25 +61,47 @@ def main():
 
     rows = []
 
-    for conference in scc_lib.Conference.ALL:
-        diffs_tried_forums = scc_lib.get_records(args.record_directory,
-                                                 conference,
-                                                 scc_lib.Stage.COMPUTE,
-                                                 full_records=True)
-
-        diff_categories = collections.Counter()
+    if args.from_table is not None:
+        for (conference, section, d_type, d_scope), count in (
+                count_categories_from_table(args.from_table).items()):
+            rows.append({
+                "conference": conference,
+                "section": section,
+                "d_type": d_type,
+                "d_scope": d_scope,
+                "count": count
+            })
+        pd.DataFrame.from_dict(rows).to_csv('temp_counts.csv')
+        return
+
+    if args.from_records:
+        for conference in scc_lib.Conference.ALL:
+            for section in ['abstract', 'intro']:
+                diff_categories = count_categories_from_records(
+                    args.record_directory, conference, section)
+                for (d_type, d_scope), count in diff_categories.items():
+                    rows.append({
+                        "conference": conference,
+                        "section": section,
+                        "d_type": d_type,
+                        "d_scope": d_scope,
+                        "count": count
+                    })
+        pd.DataFrame.from_dict(rows).to_csv('temp_counts.csv')
+        return
 
+    for conference in scc_lib.Conference.ALL:
         print(conference)
         for section in ['abstract', 'intro']:
             print("  " + section)
-
-            for forum in diffs_tried_forums:
-                if not forum[f'{section}_status'] == 'complete':
-                    continue
-                filenames = scc_lib.get_filenames(args.data_dir, conference,
-                                                  forum['forum_id'])
-                diff_categories += count_categories(
-                    filenames._asdict()[section])
+            diff_categories = collections.Counter()
+
+            query = scc_lib.CorpusQuery(args.data_dir,
+                                        args.record_directory,
+                                        conferences=[conference],
+                                        parts=[section])
+            for diff_section in query.sections():
+                diff_categories += count_categories(diff_section)
                 #if section == 'abstract':
                 #    diff_categories += count_categories(filenames.abstract)
                 #else:
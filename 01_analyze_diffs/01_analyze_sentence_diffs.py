@@ -3,7 +3,7 @@
 
 import argparse
 import collections
-import json
+import itertools
 import tqdm
 
 import scc_lib
@@ -20,79 +20,86 @@ parser.add_argument('-r',
                     type=str)
 
 
-def get_anchor_index(diff, sentence_ranges):
-    for r in sentence_ranges:
-        if diff['index'] in r:
-            return r.start
-
-
-def get_sentence(index, sentences):
-    i = 0
-    for sentence in sentences:
-        if i <= index and index < i + len(sentence):
-            return sentence
-        i += len(sentence)
-
-
-def source_to_dest_anchor(source_sentence_ranges, diffs, obj):
-    source_sentence_starts = [r.start for r in source_sentence_ranges]
-    dest_sentence_starts = list(source_sentence_starts)
-    for d in diffs:
-        offset = len(d['new']) - len(d['old'])
-        for i, source_range in enumerate(source_sentence_ranges):
-            if source_range.start > d['index']:
-                dest_sentence_starts[i] += offset
-
-    flat_source = sum(obj['tokens']['source'], [])
-    flat_dest = sum(obj['tokens']['dest'], [])
-
-    try:
-        for a, b in zip(source_sentence_starts, dest_sentence_starts):
-            #print(flat_source[a], flat_dest[b])
-            x, y = flat_source[a], flat_dest[b]
-            if not x == y:
-                print("~~", x, y)
-    except IndexError:
+def get_anchor_index(diff, sentence_index):
+    sentence = sentence_index.sentence_of(diff['index'])
+    if sentence is None:
         return None
-
-    return {k: v for k, v in zip(source_sentence_starts, dest_sentence_starts)}
+    return sentence_index.span(sentence)[0]
 
 
-def get_sentence_diff_pairs(filename):
-    with open(filename, 'r') as f:
-        obj = json.load(f)
-
-    source_sentence_ranges = scc_lib.compute_sentence_ranges(
-        obj['tokens']['source'])
-
-    source_to_dest = source_to_dest_anchor(source_sentence_ranges,
-                                           obj['diffs'], obj)
+def get_sentence(index, sentences, sentence_index):
+    """Sentence containing token index, or None."""
+    if index is None:
+        return None
+    sentence = sentence_index.sentence_of(index)
+    if sentence is None:
+        return None
+    return sentences[sentence]
+
+
+def source_to_dest_anchor(source_sentence_index, obj):
+    """Map the start of each source sentence to a dest index in the
+    corresponding dest sentence (None if nothing in the sentence is kept)."""
+    alignment = scc_lib.get_token_alignment(obj)
+    source_to_dest = {}
+    for start, end in source_sentence_index.spans():
+        dest_span = alignment.map_span(start, end)
+        source_to_dest[start] = None if dest_span is None else dest_span[0]
+    return source_to_dest
+
+
+def get_sentence_diff_pairs(section):
+    obj = scc_lib.load_section(section)
+
+    if 'sentence_pairs' in obj:
+        # Diffs computed in hierarchical mode already pair changed sentences
+        return [(obj['tokens']['source'][pair['old_sentence']],
+                 obj['tokens']['dest'][pair['new_sentence']])
+                for pair in obj['sentence_pairs']
+                if pair['old_sentence'] is not None
+                and pair['new_sentence'] is not None]
+
+    source_tokens = list(
+        itertools.chain.from_iterable(obj['tokens']['source']))
+    if not source_tokens:
+        # Nothing to anchor diffs against, as in get_document_categories
+        return []
+    dest_tokens = list(itertools.chain.from_iterable(obj['tokens']['dest']))
+    diffs = [
+        scc_lib.get_categorizable_diff(d, source_tokens, dest_tokens)
+        if 'old_index' in d else d for d in obj['diffs']
+    ]
+
+    source_sentence_index = scc_lib.SentenceIndex(obj['tokens']['source'])
+    dest_sentence_index = scc_lib.SentenceIndex(obj['tokens']['dest'])
+
+    source_to_dest = source_to_dest_anchor(source_sentence_index, obj)
 
     sentence_diff_list = []
-    for diff in obj['diffs']:
+    for diff in diffs:
         d_type, d_scope = scc_lib.get_diff_type_and_scope(
-            diff, source_sentence_ranges)
+            diff, source_sentence_index)
         if (d_scope == scc_lib.DiffScope.IN_SENTENCE
                 and not d_type == scc_lib.DiffType.TYPO):
             sentence_diff_list.append(diff)
 
+    sentence_pairs = []
     for sentence_diff in sentence_diff_list:
-        anchor_index = get_anchor_index(sentence_diff, source_sentence_ranges)
-        old_sentence = get_sentence(anchor_index, obj['tokens']['source'])
-        try:
-            new_sentence = get_sentence(source_to_dest[anchor_index],
-                                        obj['tokens']['dest'])
-            #print(sentence_diff)
-            #print(" ".join(old_sentence))
-            #print(" ".join(new_sentence))
-            #print()
-        except TypeError:
-            print("Problems")
+        anchor_index = get_anchor_index(sentence_diff, source_sentence_index)
+        if anchor_index is None:
             continue
+        old_sentence = get_sentence(anchor_index, obj['tokens']['source'],
+                                    source_sentence_index)
+        new_sentence = get_sentence(source_to_dest[anchor_index],
+                                    obj['tokens']['dest'],
+                                    dest_sentence_index)
+        if new_sentence is None:
+            # The whole sentence was rewritten, nothing to anchor it on
+            continue
+        if (old_sentence, new_sentence) not in sentence_pairs:
+            sentence_pairs.append((old_sentence, new_sentence))
 
-        #print(sentence_diff_list)
-
-    return []
+    return sentence_pairs
 
 
 ols_reconstruct = """
@@ -117,40 +124,20 @@ def reconstruct(filename):
 """
 
 
-def index_mapping(filename):
-    with open(filename, 'r') as f:
-        obj = json.load(f)
+def index_mapping(section):
+    """Check that each aligned source token is equal to its dest token."""
+    obj = scc_lib.load_section(section)
 
-    source_tokens = sum(obj['tokens']['source'], [])
-    dest_tokens = sum(obj['tokens']['dest'], [])
-
-    source_map_index = range(len(source_tokens))
-
-    reconstructed_tokens = []
-    reconstructed_indices = []
-    source_cursor = 0
-    for i, diff in enumerate(obj['diffs']):
-        upto_index = diff['index']
-        if diff['old'][0] == diff['new'][0]:
-            upto_index += 1
-        reconstructed_indices += source_map_index[source_cursor:upto_index]
-        break
-
-        reconstructed_tokens += source_tokens[source_cursor:diff['index']]
-
-        reconstructed_indices += source_map_index[source_cursor:diff['index']]
-        reconstructed_tokens += diff['new']
-        source_cursor = diff['index'] + len(diff['old'])
-        reconstructed_indices += [None] * len(diff['old'])
+    source_tokens = list(
+        itertools.chain.from_iterable(obj['tokens']['source']))
+    dest_tokens = list(itertools.chain.from_iterable(obj['tokens']['dest']))
 
-    reconstructed_tokens += source_tokens[source_cursor:]
-    reconstructed_indices += source_map_index[source_cursor:]
-
-    for i, mapped in enumerate(reconstructed_indices):
-        if mapped is not None:
-            print(source_tokens[i], dest_tokens[mapped])
-
-    return reconstructed_tokens == dest_tokens
+    alignment = scc_lib.get_token_alignment(obj)
+    for i, source_token in enumerate(source_tokens):
+        dest_index = alignment.dest_index(i)
+        if dest_index is not None and dest_tokens[dest_index] != source_token:
+            return False
+    return True
 
 
 def main():
@@ -158,20 +145,12 @@ def main():
 
     sentence_diff_pairs = []
 
-    for conference in scc_lib.Conference.ALL:
-        diffs_tried_forums = scc_lib.get_records(args.record_directory,
-                                                 conference,
-                                                 scc_lib.Stage.COMPUTE,
-                                                 full_records=True)
-        for forum in diffs_tried_forums:
-            #print(f"\nForum: {forum['forum_id']}", end="")
-            filenames = scc_lib.get_filenames(args.data_dir, conference,
-                                              forum['forum_id'])
-            for section in ['abstract', 'intro']:
-                if not forum[f'{section}_status'] == 'complete':
-                    continue
-                #reconstruct(filenames._asdict()[section])
-                index_mapping(filenames._asdict()[section])
+    query = scc_lib.CorpusQuery(args.data_dir,
+                                args.record_directory,
+                                parts=['abstract', 'intro'])
+    for section in query.sections():
+        #reconstruct(section.filename)
+        index_mapping(section)
 
 
 if __name__ == "__main__":
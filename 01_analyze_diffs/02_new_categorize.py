@@ -1,149 +1,317 @@
-DATA_DIR = "/gypsum/work1/mccallum/nnayak/latmod/"
-RECORDS_DIR = ("/work/pi_mccallum_umass_edu/nnayak_umass_edu/"
-               "latourian_modality/00_extract_data/records/")
+"""Label each computed diff (typo, word change, within sentence, ...)
+and write the labels to a Parquet table.
+"""
 
+import argparse
 import collections
-import json
+import itertools
+import multiprocessing
+import os
 import pickle
 import tqdm
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 from nltk.corpus import words
-from nltk.metrics.distance import edit_distance
 from nltk.util import ngrams
-from nltk.stem import *
 
+import scc_distance_lib
+import scc_label_cache_lib
+import scc_lexicon_lib
 import scc_lib
+import scc_vocabulary_lib
 
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-d",
+                    "--data_dir",
+                    default="/gypsum/work1/mccallum/nnayak/latmod/",
+                    type=str,
+                    help="Data dir")
+parser.add_argument('-r',
+                    '--record_directory',
+                    default=('/work/pi_mccallum_umass_edu/nnayak_umass_edu/'
+                             'latourian_modality/00_extract_data/records/'),
+                    type=str)
+parser.add_argument('-c', '--counts_file', default='counts.txt', type=str)
+parser.add_argument('-v',
+                    '--vocabulary_file',
+                    default='vocabulary.npz',
+                    type=str,
+                    help='built by build_vocabulary.py')
+parser.add_argument('-l', '--label_cache', default='labels.cache', type=str)
+parser.add_argument('-o',
+                    '--output_file',
+                    default='diff_labels.parquet',
+                    type=str)
+parser.add_argument('-n',
+                    '--num_workers',
+                    default=os.cpu_count(),
+                    type=int,
+                    help='number of processes labeling forums')
 
-def get_surface(tokens, with_spaces=False):
-    surface = "".join(tokens).replace("-", "")
-    return surface.replace("ﬁ", "fi")
 
+def is_spacing_hyphenation(old_ids, new_ids, vocabulary):
+    return vocabulary.surface(old_ids) == vocabulary.surface(new_ids)
 
-def is_spacing_hyphenation(old_surface, new_surface):
-    return old_surface == new_surface
-
-def is_non_alphabetic(old_surface, new_surface):
-    chars = old_surface + new_surface
-    alpha_chars = [x for x in chars if x.isalpha()]
-    return len(alpha_chars) < len(chars) / 2
-
-def load_counts(min_count=0):
-    counts = {}
-    with open('counts.txt', 'r') as f:
-        for line in f:
-            token, count = line.split()
-            counts[token] = int(count)
-    return counts
-
+def is_non_alphabetic(old_ids, new_ids, vocabulary):
+    token_ids = old_ids + new_ids
+    num_chars = sum(vocabulary.surface_lengths[i] for i in token_ids)
+    num_alpha_chars = sum(vocabulary.surface_alpha_counts[i]
+                          for i in token_ids)
+    return num_alpha_chars < num_chars / 2
 
 TYPO_EDIT_DISTANCE = 3
-STEMMER = PorterStemmer()
 
-def is_typographical(old_token, new_token, spell_check_counts):
-    if edit_distance(old_token, new_token) < TYPO_EDIT_DISTANCE:
-        old_count = spell_check_counts.get(old_token.lower())
-        new_count = spell_check_counts.get(new_token.lower())
-        if old_count is None and new_count is not None:
+def is_typographical(old_id, new_id, vocabulary):
+    if scc_distance_lib.is_within_edit_distance(vocabulary.tokens[old_id],
+                                                vocabulary.tokens[new_id],
+                                                TYPO_EDIT_DISTANCE):
+        if (not vocabulary.in_lexicon(old_id)
+                and vocabulary.in_lexicon(new_id)):
             return True  # Old word is not a word, new word is a word
-    if STEMMER.stem(old_token) == STEMMER.stem(new_token):
+    if vocabulary.stem_ids[old_id] == vocabulary.stem_ids[new_id]:
         return True
     return False
 
 
-def is_subsequence(needle, haystack):
-    for i in range(len(haystack)):
-        if haystack[i:i + len(needle)] == needle:
+NGRAM_LEN = 3
+
+
+class SentenceNgramIndex(object):
+    """Positions of the hashed 1- to NGRAM_LEN-grams that lie within a
+    sentence, for finding token sequences without a known position.
+    """
+
+    def __init__(self, sentences):
+        self.tokens = list(itertools.chain.from_iterable(sentences))
+        self.sentence_index = scc_lib.SentenceIndex(sentences)
+        self.positions = collections.defaultdict(list)
+        for start, end in self.sentence_index.spans():
+            for i in range(start, end):
+                for n in range(1, min(NGRAM_LEN, end - i) + 1):
+                    self.positions[hash(tuple(self.tokens[i:i + n]))].append(i)
+
+    def is_in_sentence(self, needle):
+        """Whether needle occurs contiguously within one sentence."""
+        if not needle:
+            return bool(self.tokens)
+        prefix = tuple(needle[:NGRAM_LEN])
+        for i in self.positions.get(hash(prefix), []):
+            # Positions are verified, hashes of different n-grams may collide
+            if (self.tokens[i:i + len(needle)] == needle
+                    and self.sentence_index.is_within_sentence(
+                        i, i + len(needle))):
+                return True
+        return False
+
+
+class DocumentIndex(object):
+    """Sentence lookups for the source and dest of one diff file. n-gram
+    indices are only built if a diff without positions needs them.
+    """
+
+    def __init__(self, obj):
+        self.tokens = obj['tokens']
+        self.sentence_indices = {
+            side: scc_lib.SentenceIndex(sentences)
+            for side, sentences in self.tokens.items()
+        }
+        self.ngram_indices = {}
+
+    def is_span_in_sentence(self, side, tokens, start=None):
+        """Whether tokens, starting at start (if known) in the side document,
+        are within one sentence."""
+        if not tokens:
             return True
-    return False
+        if start is not None:
+            return self.sentence_indices[side].is_within_sentence(
+                start, start + len(tokens))
+        if side not in self.ngram_indices:
+            self.ngram_indices[side] = SentenceNgramIndex(self.tokens[side])
+        return self.ngram_indices[side].is_in_sentence(tokens)
 
 
-def is_within_sentence(d, source_sentence_list, dest_sentence_list):
+def is_within_sentence(d, document_index):
     """Diff is considered within sentence if old and new subsequences each fall
     within a sentence."""
 
+    old_start, new_start = d.get('index'), d.get('new_index')
     if d['old'] and d['new'] and d['old'][0] == d['new'][0] == '.':
         old = d['old'][1:]
         new = d['new'][1:]
+        old_start = None if old_start is None else old_start + 1
+        new_start = None if new_start is None else new_start + 1
     else:
         old, new = d['old'], d['new']
 
-    for s_s in source_sentence_list:
-        if is_subsequence(old, s_s):
-            for s_d in dest_sentence_list:
-                if is_subsequence(new, s_d):
-                    #print(d)
-                    #print(" ".join(s_s))
-                    #print(" ".join(s_d))
-                    #print()
-                    return True
-    return False
+    return (document_index.is_span_in_sentence('source', old, old_start)
+            and document_index.is_span_in_sentence('dest', new, new_start))
+
+
+# Bump when the labels below change, so cached labels are not reused
+CLASSIFIER_VERSION = 1
+# Longer diffs rarely recur and mostly get no label from their tokens alone,
+# so they are labeled without the cache
+MAX_CACHED_DIFF_LEN = 2
 
 
-def get_diff_type(d, obj, spell_check_counts):
-    old_surface = get_surface(d['old'])
-    new_surface = get_surface(d['new'])
-    if is_spacing_hyphenation(old_surface, new_surface):
+def get_token_diff_type(old, new, vocabulary):
+    """Label of a diff that only depends on its tokens, or None if it depends
+    on the sentences around it."""
+    old_ids = vocabulary.ids(old)
+    new_ids = vocabulary.ids(new)
+    if is_spacing_hyphenation(old_ids, new_ids, vocabulary):
         return "NON_DIFF"
 
-    lengths = (len(d['old']), len(d['new']))
-    if is_non_alphabetic(old_surface, new_surface):
+    lengths = (len(old), len(new))
+    if is_non_alphabetic(old_ids, new_ids, vocabulary):
         return "NONALPHA"
     if lengths == (1, 1):
-        if is_typographical(*d['old'], *d['new'], spell_check_counts):
+        if is_typographical(*old_ids, *new_ids, vocabulary):
             return "TYPO"
         else:
             return "WORD_CHANGE"
     elif lengths == (1, 0):
         return "DELETE_WORD"
-    elif lengths == (1, 2) and d['old'][0] == d['new'][0]:
+    elif lengths == (1, 2) and old[0] == new[0]:
         return "INSERT_WORD"
+    return None
+
+
+def get_diff_type(d, document_index, vocabulary, label_cache):
+    if max(len(d['old']), len(d['new'])) <= MAX_CACHED_DIFF_LEN:
+        diff_type = label_cache.get_or_compute(
+            d['old'], d['new'],
+            lambda: get_token_diff_type(d['old'], d['new'], vocabulary))
     else:
-        if is_within_sentence(d, obj['tokens']['source'],
-                              obj['tokens']['dest']):
-            return "WITHIN_SENTENCE"
+        diff_type = get_token_diff_type(d['old'], d['new'], vocabulary)
+    if diff_type is not None:
+        return diff_type
+    if is_within_sentence(d, document_index):
+        return "WITHIN_SENTENCE"
+    else:
+        return "MULTI_SENTENCE"
+
+
+def label_diffs(section, vocabulary, label_cache):
+    """(diff, label) for each diff of a section."""
+    obj = scc_lib.load_section(section)
+    document_index = DocumentIndex(obj)
+    source_tokens = list(itertools.chain.from_iterable(
+        obj['tokens']['source']))
+    dest_tokens = list(itertools.chain.from_iterable(obj['tokens']['dest']))
+    labeled_diffs = []
+    for d in obj['diffs']:
+        if 'old_index' in d:  # Written by the compute stage
+            categorizable_diff = scc_lib.get_categorizable_diff(
+                d, source_tokens, dest_tokens)
         else:
-            return "MULTI_SENTENCE"
+            categorizable_diff = d
+        labeled_diffs.append(
+            (d,
+             get_diff_type(categorizable_diff, document_index, vocabulary,
+                           label_cache)))
+    return labeled_diffs
 
 
-def filter_diffs(filename, spell_check_counts):
+def filter_diffs(section, vocabulary, label_cache):
     diffs_by_type = collections.defaultdict(list)
-    with open(filename, 'r') as f:
-        obj = json.load(f)
-        for d in obj['diffs']:
-            diff_type = get_diff_type(d, obj, spell_check_counts)
-            #if diff_type in ["WORD_CHANGE", "INSERT_WORD", "DELETE_WORD"]:
-            #if diff_type in ["NONALPHA"]:
-            _ = """
-                print("-" * 80)
-                print(" ".join(d['old']))
-                print(" ".join(d['new']))
-                print("-" * 80)
-                print()"""
-            print(diff_type)
-            diffs_by_type[diff_type].append(d)
-        return diffs_by_type
-
-
-total = 0
-non_typos = 0
-for conference in scc_lib.Conference.ALL:
-    print(conference)
-    diffs_tried_forums = scc_lib.get_records(RECORDS_DIR,
-                                             conference,
-                                             scc_lib.Stage.COMPUTE,
-                                             full_records=True)
-    spell_check_counts = load_counts(100)
-    for section in ['abstract', 'intro']:
-        print(section)
-        for forum in tqdm.tqdm(diffs_tried_forums):
-            if not forum[f'{section}_status'] == 'complete':
-                continue
-            filenames = scc_lib.get_filenames(DATA_DIR, conference,
-                                              forum['forum_id'])
-            filtered_diffs = filter_diffs(filenames._asdict()[section],
-                                          spell_check_counts)
-            with open(filenames._asdict()[section], 'r') as f:
-                obj = json.load(f)
-                total += len(obj['diffs'])
-            non_typos += len(filtered_diffs)
+    for d, diff_type in label_diffs(section, vocabulary, label_cache):
+        diffs_by_type[diff_type].append(d)
+    return diffs_by_type
+
+
+# == Parallel labeling ========================================================
+
+LABEL_SCHEMA = pa.schema([
+    ("conference", pa.string()),
+    ("forum_id", pa.string()),
+    ("part", pa.string()),
+    ("source", pa.string()),
+    ("dest", pa.string()),
+    ("old_index", pa.int64()),
+    ("new_index", pa.int64()),
+    ("label", pa.string()),
+])
+
+_worker_state = {}
+
+
+def _init_worker(vocabulary_file, lexicon_file, label_cache):
+    # The lexicon is built (if needed) by the main process; workers only map
+    # it, sharing its pages
+    _worker_state['vocabulary'] = scc_vocabulary_lib.Vocabulary.load(
+        vocabulary_file, scc_lexicon_lib.Lexicon(lexicon_file))
+    _worker_state['label_cache'] = label_cache
+
+
+def label_forum(sections):
+    """Label the diffs of the sections of one forum in a worker process.
+
+    Returns label table columns, and the labels and lookup counts of the
+    worker's label cache for merging into the main one.
+    """
+    vocabulary = _worker_state['vocabulary']
+    label_cache = _worker_state['label_cache']
+    hits, misses = label_cache.hits, label_cache.misses
+    columns = {name: [] for name in LABEL_SCHEMA.names}
+    for section in sections:
+        for d, label in label_diffs(section, vocabulary, label_cache):
+            for name, value in [("conference", section.forum.conference),
+                                ("forum_id", section.forum.forum_id),
+                                ("part", section.part),
+                                ("source", section.source),
+                                ("dest", section.dest),
+                                ("old_index", d.get('old_index')),
+                                ("new_index", d.get('new_index')),
+                                ("label", label)]:
+                columns[name].append(value)
+    return (columns, label_cache.pop_new_labels(), label_cache.hits - hits,
+            label_cache.misses - misses)
+
+
+def main():
+    args = parser.parse_args()
+
+    sections_by_forum = collections.defaultdict(list)
+    for section in scc_lib.CorpusQuery(args.data_dir,
+                                       args.record_directory).sections():
+        sections_by_forum[section.forum].append(section)
+    tasks = list(sections_by_forum.values())
+
+    # Build a missing or stale lexicon once, before forking the workers
+    scc_lexicon_lib.load_lexicon(args.counts_file).close()
+
+    # Typo labels depend on the spell-check counts and on the token
+    # frequencies frozen into the vocabulary, so both are part of the cache
+    # key
+    label_cache = scc_label_cache_lib.LabelCache(
+        args.label_cache,
+        (CLASSIFIER_VERSION, os.path.getmtime(args.counts_file),
+         os.path.getmtime(args.vocabulary_file)))
+    columns = {name: [] for name in LABEL_SCHEMA.names}
+    with multiprocessing.Pool(args.num_workers,
+                              initializer=_init_worker,
+                              initargs=(args.vocabulary_file,
+                                        scc_lexicon_lib.get_lexicon_filename(
+                                            args.counts_file),
+                                        label_cache)) as pool:
+        results = pool.imap_unordered(label_forum, tasks)
+        for forum_columns, new_labels, hits, misses in tqdm.tqdm(
+                results, total=len(tasks)):
+            for name, values in forum_columns.items():
+                columns[name] += values
+            label_cache.merge(new_labels, hits, misses)
+
+    table = pa.table(columns, schema=LABEL_SCHEMA)
+    pq.write_table(table, args.output_file)
+    label_cache.save()
+
+    for label, count in collections.Counter(columns["label"]).most_common():
+        print(f'{label}\t{count}')
+    print(f'{table.num_rows} diffs labeled')
+    print(label_cache.summary())
+
+
+if __name__ == "__main__":
+    main()
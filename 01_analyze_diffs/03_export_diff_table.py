@@ -0,0 +1,126 @@
+"""Export all computed diffs into one Parquet dataset, one row per diff,
+partitioned by conference and part.
+
+Category counts (as in 00_categorize.py) then become group-bys, e.g.
+    pd.read_parquet(table_dir).groupby(["conference", "part", "diff_type",
+                                        "diff_scope"]).size()
+"""
+
+import argparse
+import tqdm
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import scc_lib
+import scc_store_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-d", "--data_dir", type=str, help="Data dir")
+parser.add_argument('-r',
+                    '--record_directory',
+                    default=('/work/pi_mccallum_umass_edu/nnayak_umass_edu/'
+                             'latourian_modality/00_extract_data/records/'),
+                    type=str)
+parser.add_argument('-o',
+                    '--output_directory',
+                    default='diff_table/',
+                    type=str,
+                    help='root of the partitioned dataset')
+parser.add_argument('-c',
+                    '--conference',
+                    type=str,
+                    choices=scc_lib.Conference.ALL,
+                    help='only export (and replace) this conference')
+
+SCHEMA = pa.schema([
+    ("conference", pa.string()),
+    ("forum_id", pa.string()),
+    ("part", pa.string()),
+    ("source", pa.string()),
+    ("dest", pa.string()),
+    ("old_index", pa.int64()),
+    ("new_index", pa.int64()),
+    ("old_length", pa.int64()),
+    ("new_length", pa.int64()),
+    ("diff_type", pa.string()),
+    ("diff_scope", pa.string()),
+])
+PARTITION_COLUMNS = ["conference", "part"]
+
+
+def get_diff_columns(section):
+    """Per-diff columns of one section.
+
+    Binary files with stored categories are read without their tokens;
+    otherwise categories are computed as in 00_categorize.py.
+    """
+    if section.name.endswith(".npz"):
+        with section.forum.storage.open(section.forum.forum_id, section.name,
+                                        'rb') as f:
+            binary_diffs = scc_store_lib.load_diffs(f)
+        if binary_diffs.diff_type is not None:
+            return {
+                "old_index": binary_diffs.old_index.tolist(),
+                "new_index": binary_diffs.new_index.tolist(),
+                "old_length": binary_diffs.old_lengths.tolist(),
+                "new_length": binary_diffs.new_lengths.tolist(),
+                "diff_type": binary_diffs.diff_type.tolist(),
+                "diff_scope": binary_diffs.diff_scope.tolist(),
+            }
+
+    obj = scc_lib.load_section(section)
+    categories = obj.get('categories')
+    if categories is None:
+        categories = scc_lib.get_document_categories(obj)
+    return {
+        "old_index": [d['old_index'] for d in obj['diffs']],
+        "new_index": [d['new_index'] for d in obj['diffs']],
+        "old_length": [
+            sum(len(s) for s in d['old_tokens']) for d in obj['diffs']
+        ],
+        "new_length": [
+            sum(len(s) for s in d['new_tokens']) for d in obj['diffs']
+        ],
+        "diff_type": [diff_type for diff_type, _ in categories],
+        "diff_scope": [diff_scope for _, diff_scope in categories],
+    }
+
+
+def export_conference(data_dir, record_directory, conference):
+    columns = {name: [] for name in SCHEMA.names}
+    query = scc_lib.CorpusQuery(data_dir,
+                                record_directory,
+                                conferences=[conference])
+    for section in tqdm.tqdm(query.sections()):
+        diff_columns = get_diff_columns(section)
+        num_diffs = len(diff_columns["old_index"])
+        for name, value in [("conference", conference),
+                            ("forum_id", section.forum.forum_id),
+                            ("part", section.part), ("source", section.source),
+                            ("dest", section.dest)]:
+            columns[name] += [value] * num_diffs
+        for name, values in diff_columns.items():
+            columns[name] += values
+    return pa.table(columns, schema=SCHEMA)
+
+
+def main():
+    args = parser.parse_args()
+
+    conferences = ([args.conference]
+                   if args.conference else scc_lib.Conference.ALL)
+    for conference in conferences:
+        print(conference)
+        table = export_conference(args.data_dir, args.record_directory,
+                                  conference)
+        print(f'  {table.num_rows} diffs')
+        # Re-exporting a conference replaces its partitions
+        pq.write_to_dataset(table,
+                            args.output_directory,
+                            partition_cols=PARTITION_COLUMNS,
+                            existing_data_behavior='delete_matching')
+
+
+if __name__ == "__main__":
+    main()
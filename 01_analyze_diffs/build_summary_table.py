@@ -0,0 +1,158 @@
+"""Build the per-forum summary table (statuses, decision, review scores)
+that plots.ipynb loads.
+"""
+
+import argparse
+import json
+import tqdm
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import scc_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-d", "--data_dir", type=str, help="Data dir")
+parser.add_argument('-r',
+                    '--record_directory',
+                    default=('/work/pi_mccallum_umass_edu/nnayak_umass_edu/'
+                             'latourian_modality/00_extract_data/records/'),
+                    type=str)
+parser.add_argument('-o',
+                    '--output_file',
+                    default='latmod_summary.parquet',
+                    type=str)
+
+ACCEPT_STRINGS = [
+    "Accept (Oral)",
+    "Accept (Poster)",
+]
+REJECT_STRINGS = [
+    "Reject",
+    "Invite to Workshop Track",
+]
+ACCEPT_MAP = {k: "accept" for k in ACCEPT_STRINGS}
+ACCEPT_MAP.update({k: "reject" for k in REJECT_STRINGS})
+
+SCHEMA = pa.schema([
+    ("conference", pa.string()),
+    ("forum_id", pa.string()),
+    ("download_status", pa.string()),
+    ("decision", pa.string()),
+    ("extract_status", pa.string()),
+    ("abstract_status", pa.string()),
+    ("intro_status", pa.string()),
+    ("review_scores", pa.list_(pa.float64())),
+    ("avg_score", pa.float64()),
+    ("clean_status", pa.string()),
+    ("clean_decision", pa.string()),
+])
+
+
+def get_review_scores(forum):
+    """Numeric ratings of a forum's reviews, e.g. 6 for "6: Marginally above
+    acceptance threshold"."""
+    if not forum.storage.exists(forum.forum_id, "metadata.json"):
+        return []
+    with forum.storage.open(forum.forum_id, "metadata.json", 'r') as f:
+        reviews = json.load(f)['reviews'] or []
+    scores = []
+    for review in reviews:
+        try:
+            scores.append(float(str(review['rating']).split(":")[0]))
+        except ValueError:
+            continue
+    return scores
+
+
+def get_part_statuses(record_directory, conference):
+    """Status per (forum, part): complete if any version pair of the part was
+    diffed, else the status of its last record."""
+    part_statuses = {}
+    for record in scc_lib.iter_records(record_directory, conference,
+                                       scc_lib.Stage.COMPUTE):
+        key = record['forum_id'], record['part']
+        if part_statuses.get(key) != "complete":
+            part_statuses[key] = record['status']
+    return part_statuses
+
+
+def get_average_scores(review_scores):
+    """Mean of each list of scores (NaN for no scores)."""
+    flat_scores = pc.list_flatten(review_scores).to_numpy()
+    forum_indices = pc.list_parent_indices(review_scores).to_numpy()
+    sums = np.bincount(forum_indices,
+                       weights=flat_scores,
+                       minlength=len(review_scores))
+    counts = np.bincount(forum_indices, minlength=len(review_scores))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def get_clean_statuses(columns):
+    """Overall status of each forum, from the statuses of all stages."""
+    download_status = np.array(columns["download_status"], dtype=object)
+    extract_status = np.array(columns["extract_status"], dtype=object)
+    any_part_complete = ((np.array(columns["abstract_status"]) == "complete")
+                         | (np.array(columns["intro_status"]) == "complete"))
+    extracted = np.isin(extract_status, [
+        scc_lib.ExtractionStatus.COMPLETE, scc_lib.ExtractionStatus.NO_CHANGE
+    ])
+    return np.select([
+        download_status != scc_lib.DownloadStatus.COMPLETE,
+        extracted & any_part_complete,
+        extracted,
+        extract_status == scc_lib.ExtractionStatus.ERROR,
+    ], [download_status, "complete", "no_revision", "extract_error"],
+                     default=None)
+
+
+def get_clean_decisions(decisions):
+    """accept or reject (or None) for each decision string."""
+    decisions = np.array(decisions, dtype=object)
+    clean_decisions = np.full(len(decisions), None, dtype=object)
+    for decision, clean_decision in ACCEPT_MAP.items():
+        clean_decisions[decisions == decision] = clean_decision
+    return clean_decisions
+
+
+def main():
+    args = parser.parse_args()
+
+    columns = {name: [] for name in SCHEMA.names}
+    for conference in scc_lib.Conference.ALL:
+        extract_statuses = {
+            record['forum_id']: record['status']
+            for record in scc_lib.iter_records(
+                args.record_directory, conference, scc_lib.Stage.EXTRACT)
+        }
+        part_statuses = get_part_statuses(args.record_directory, conference)
+        query = scc_lib.CorpusQuery(args.data_dir,
+                                    args.record_directory,
+                                    conferences=[conference],
+                                    statuses=None)
+        for forum in tqdm.tqdm(query.forums()):
+            columns["conference"].append(conference)
+            columns["forum_id"].append(forum.forum_id)
+            columns["download_status"].append(forum.status)
+            columns["decision"].append(forum.decision)
+            columns["extract_status"].append(
+                extract_statuses.get(forum.forum_id))
+            for part in ["abstract", "intro"]:
+                columns[f"{part}_status"].append(
+                    part_statuses.get((forum.forum_id, part)))
+            columns["review_scores"].append(get_review_scores(forum))
+
+    review_scores = pa.array(columns["review_scores"],
+                             type=SCHEMA.field("review_scores").type)
+    columns["review_scores"] = review_scores
+    columns["avg_score"] = get_average_scores(review_scores)
+    columns["clean_status"] = get_clean_statuses(columns)
+    columns["clean_decision"] = get_clean_decisions(columns["decision"])
+    pq.write_table(pa.table(columns, schema=SCHEMA), args.output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Build the vocabulary feature table used by 02_new_categorize.py
+"""
+
+import argparse
+import tqdm
+
+import scc_lexicon_lib
+import scc_lib
+import scc_vocabulary_lib
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-d", "--data_dir", type=str, help="Data dir")
+parser.add_argument('-r',
+                    '--record_directory',
+                    default=('/work/pi_mccallum_umass_edu/nnayak_umass_edu/'
+                             'latourian_modality/00_extract_data/records/'),
+                    type=str)
+parser.add_argument('-c', '--counts_file', default='counts.txt', type=str)
+parser.add_argument('-o',
+                    '--output_file',
+                    default='vocabulary.npz',
+                    type=str)
+parser.add_argument('-p',
+                    '--prefetch',
+                    default=4,
+                    type=int,
+                    help='number of diff files loaded ahead')
+
+
+def main():
+    args = parser.parse_args()
+
+    vocabulary = scc_vocabulary_lib.Vocabulary(
+        scc_lexicon_lib.load_lexicon(args.counts_file))
+    query = scc_lib.CorpusQuery(args.data_dir,
+                                args.record_directory,
+                                prefetch=args.prefetch)
+    for _, obj in tqdm.tqdm(query.documents()):
+        for sentences in obj['tokens'].values():
+            for sentence in sentences:
+                vocabulary.ids(sentence)
+
+    print(f'{len(vocabulary)} tokens')
+    vocabulary.save(args.output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Persistent cache of diff labels keyed by the diff's tokens.
+
+The same small edits (ligature fixes, "a" -> "an", capitalization) recur
+across thousands of papers. Labels that only depend on a diff's old and new
+tokens are cached under a hash of those tokens and the classifier version, so
+that repeated runs skip most classification.
+"""
+
+import collections
+import hashlib
+import os
+import pickle
+
+MAX_SIZE = 1000000
+_MISSING = object()
+
+
+def get_key(version, old, new):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(pickle.dumps((version, tuple(old), tuple(new))))
+    return h.digest()
+
+
+class LabelCache(object):
+    """Bounded least-recently-used map from (old, new) tokens to a label.
+
+    Keys include the classifier version, so entries from an older classifier
+    are never returned; they are evicted as they fall out of use.
+    """
+
+    def __init__(self, filename, version, max_size=MAX_SIZE):
+        self.filename = filename
+        self.version = version
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.labels = collections.OrderedDict()
+        self.new_labels = {}  # Computed since the last pop_new_labels
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                self.labels = pickle.load(f)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get_or_compute(self, old, new, classify):
+        """Label of the diff, from the cache or from classify().
+
+        None (no label from the tokens alone) is not cached.
+        """
+        key = get_key(self.version, old, new)
+        label = self.labels.get(key, _MISSING)
+        if label is _MISSING:
+            self.misses += 1
+            label = classify()
+            if label is not None:
+                self.new_labels[key] = label
+                self._add(key, label)
+        else:
+            self.hits += 1
+            self.labels.move_to_end(key)
+        return label
+
+    def _add(self, key, label):
+        self.labels[key] = label
+        self.labels.move_to_end(key)
+        if len(self.labels) > self.max_size:
+            self.labels.popitem(last=False)
+
+    def pop_new_labels(self):
+        """Labels computed since the last call, e.g. by a worker process."""
+        new_labels, self.new_labels = self.new_labels, {}
+        return new_labels
+
+    def merge(self, new_labels, hits, misses):
+        """Add labels and lookup counts from another (worker) cache."""
+        for key, label in new_labels.items():
+            self._add(key, label)
+        self.hits += hits
+        self.misses += misses
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        return (f'label cache: {self.hits} hits, {self.misses} misses '
+                f'({self.hit_rate():.1%} hit rate), {len(self)} entries')
+
+    def save(self):
+        if self.filename is None:
+            return
+        temp_filename = f'{self.filename}.{os.getpid()}.tmp'
+        with open(temp_filename, 'wb') as f:
+            pickle.dump(self.labels, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, self.filename)
@@ -0,0 +1,133 @@
+"""Memory-mapped lexicon of spell-check counts.
+
+counts.txt (token<TAB>count per line, as written by spellcheck.py) is
+converted once into a sorted string table:
+
+    header    MAGIC, number of tokens n, size of the token blob
+    offsets   n + 1 uint64, start of each token in the blob
+    counts    n uint64
+    blob      utf-8 tokens, sorted by their bytes
+
+The file is memory-mapped, so loading it takes no parsing, lookups bisect the
+table in O(log n), and processes that load the same lexicon share its pages.
+"""
+
+import array
+import mmap
+import os
+import struct
+
+MAGIC = b"SCCLEX01"
+HEADER = struct.Struct("<8sQQ")
+ITEM_FORMAT = "Q"  # Native uint64, as in memoryview.cast
+
+
+def get_lexicon_filename(counts_filename):
+    return os.path.splitext(counts_filename)[0] + ".lex"
+
+
+def read_counts(counts_filename):
+    """Read counts.txt into a dict. Tokens listed more than once (e.g. by
+    different unigram shards) keep their last count."""
+    counts = {}
+    with open(counts_filename, 'r') as f:
+        for line in f:
+            token, count = line.rstrip("\n").rsplit("\t", 1)
+            counts[token] = int(count)
+    return counts
+
+
+def build_lexicon(counts, lexicon_filename):
+    """Write a lexicon for a dict of token counts."""
+    encoded = sorted(
+        (token.encode(), count) for token, count in counts.items())
+    offsets = array.array(ITEM_FORMAT, [0])
+    for token, _ in encoded:
+        offsets.append(offsets[-1] + len(token))
+    frequencies = array.array(ITEM_FORMAT, [count for _, count in encoded])
+
+    # Written to a temporary file first, so that concurrent readers never map
+    # a partial lexicon
+    temp_filename = f'{lexicon_filename}.{os.getpid()}.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(encoded), offsets[-1]))
+        f.write(offsets.tobytes())
+        f.write(frequencies.tobytes())
+        for token, _ in encoded:
+            f.write(token)
+    os.replace(temp_filename, lexicon_filename)
+
+
+class Lexicon(object):
+    """Read-only token -> count mapping backed by a lexicon file."""
+
+    def __init__(self, lexicon_filename):
+        with open(lexicon_filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._num_tokens, blob_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f'{lexicon_filename} is not a lexicon file')
+
+        item_size = array.array(ITEM_FORMAT).itemsize
+        view = memoryview(self._mmap)
+        offsets_start = HEADER.size
+        counts_start = offsets_start + (self._num_tokens + 1) * item_size
+        blob_start = counts_start + self._num_tokens * item_size
+        self._offsets = view[offsets_start:counts_start].cast(ITEM_FORMAT)
+        self._counts = view[counts_start:blob_start].cast(ITEM_FORMAT)
+        self._blob = view[blob_start:blob_start + blob_size]
+        view.release()
+
+    def __len__(self):
+        return self._num_tokens
+
+    def _token(self, i):
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]])
+
+    def _find(self, token):
+        key = token.encode()
+        lo, hi = 0, self._num_tokens
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._token(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._num_tokens and self._token(lo) == key:
+            return lo
+        return None
+
+    def get(self, token, default=None):
+        i = self._find(token)
+        return default if i is None else self._counts[i]
+
+    def __contains__(self, token):
+        return self._find(token) is not None
+
+    def __getitem__(self, token):
+        i = self._find(token)
+        if i is None:
+            raise KeyError(token)
+        return self._counts[i]
+
+    def close(self):
+        for view in [self._offsets, self._counts, self._blob]:
+            view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_lexicon(counts_filename='counts.txt'):
+    """Map the lexicon for counts_filename, (re)building it first if it is
+    missing or older than counts_filename."""
+    lexicon_filename = get_lexicon_filename(counts_filename)
+    if (not os.path.exists(lexicon_filename) or
+            os.path.getmtime(lexicon_filename) <
+            os.path.getmtime(counts_filename)):
+        build_lexicon(read_counts(counts_filename), lexicon_filename)
+    return Lexicon(lexicon_filename)
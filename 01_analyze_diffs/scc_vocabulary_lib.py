@@ -0,0 +1,137 @@
+"""Per-token features for categorizing diffs, computed once per corpus.
+
+The vocabulary of all diff files is collected by build_vocabulary.py. Each
+token gets an id, and its features (surface form, stem, lexicon frequency of
+its lowercased form, character counts) are stored in arrays indexed by that
+id, so categorizing a diff only needs lookups.
+"""
+
+import array
+import itertools
+
+import numpy as np
+from nltk.stem import PorterStemmer
+
+FORMAT_VERSION = 1
+NOT_IN_LEXICON = -1
+NUMERIC_COLUMNS = [
+    "stem_ids", "frequencies", "surface_lengths", "surface_alpha_counts"
+]
+
+STEMMER = PorterStemmer()
+
+
+def get_surface(token):
+    """Token with hyphens removed and ligatures expanded."""
+    return token.replace("-", "").replace("ﬁ", "fi")
+
+
+def _encode_strings(strings):
+    encoded = [string.encode() for string in strings]
+    return (np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            np.array(list(
+                itertools.accumulate((len(e) for e in encoded), initial=0)),
+                     dtype=np.int64))
+
+
+def _decode_strings(string_bytes, offsets):
+    string_bytes = string_bytes.tobytes()
+    offsets = offsets.tolist()
+    return [
+        string_bytes[start:end].decode()
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+class Vocabulary(object):
+    """Token features in arrays indexed by token id.
+
+    Tokens that are not in the table yet (e.g. from diffs computed after it
+    was built) are added on first lookup, which needs the lexicon.
+    """
+
+    def __init__(self, lexicon=None):
+        self.lexicon = lexicon
+        self.token_ids = {}
+        self.tokens = []
+        self.surfaces = []
+        self.stem_ids = array.array('q')
+        self.frequencies = array.array('q')
+        self.surface_lengths = array.array('q')
+        self.surface_alpha_counts = array.array('q')
+        self._stem_ids = {}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def add(self, token):
+        assert self.lexicon is not None, "Adding tokens needs a lexicon"
+        surface = get_surface(token)
+        self.token_ids[token] = len(self.tokens)
+        self.tokens.append(token)
+        self.surfaces.append(surface)
+        self.stem_ids.append(
+            self._stem_ids.setdefault(STEMMER.stem(token),
+                                      len(self._stem_ids)))
+        self.frequencies.append(
+            self.lexicon.get(token.lower(), NOT_IN_LEXICON))
+        self.surface_lengths.append(len(surface))
+        self.surface_alpha_counts.append(
+            sum(1 for char in surface if char.isalpha()))
+        return self.token_ids[token]
+
+    def id(self, token):
+        token_id = self.token_ids.get(token)
+        return self.add(token) if token_id is None else token_id
+
+    def ids(self, tokens):
+        return [self.id(token) for token in tokens]
+
+    def surface(self, token_ids):
+        return "".join(self.surfaces[i] for i in token_ids)
+
+    def in_lexicon(self, token_id):
+        return self.frequencies[token_id] != NOT_IN_LEXICON
+
+    def save(self, filename):
+        token_bytes, token_offsets = _encode_strings(self.tokens)
+        surface_bytes, surface_offsets = _encode_strings(self.surfaces)
+        stem_bytes, stem_offsets = _encode_strings(self._stem_ids)
+        with open(filename, 'wb') as f:
+            np.savez_compressed(
+                f,
+                format_version=np.array(FORMAT_VERSION),
+                token_bytes=token_bytes,
+                token_offsets=token_offsets,
+                surface_bytes=surface_bytes,
+                surface_offsets=surface_offsets,
+                stem_bytes=stem_bytes,
+                stem_offsets=stem_offsets,
+                **{
+                    column: np.array(getattr(self, column), dtype=np.int64)
+                    for column in NUMERIC_COLUMNS
+                })
+
+    @classmethod
+    def load(cls, filename, lexicon=None):
+        vocabulary = cls(lexicon)
+        with np.load(filename) as arrays:
+            if int(arrays['format_version']) != FORMAT_VERSION:
+                raise ValueError(f'{filename} has format version '
+                                 f'{int(arrays["format_version"])}, '
+                                 f'expected {FORMAT_VERSION}')
+            vocabulary.tokens = _decode_strings(arrays['token_bytes'],
+                                                arrays['token_offsets'])
+            vocabulary.surfaces = _decode_strings(arrays['surface_bytes'],
+                                                  arrays['surface_offsets'])
+            stems = _decode_strings(arrays['stem_bytes'],
+                                    arrays['stem_offsets'])
+            for column in NUMERIC_COLUMNS:
+                setattr(vocabulary, column,
+                        array.array('q', arrays[column].tobytes()))
+        vocabulary.token_ids = {
+            token: i
+            for i, token in enumerate(vocabulary.tokens)
+        }
+        vocabulary._stem_ids = {stem: i for i, stem in enumerate(stems)}
+        return vocabulary
@@ -1,30 +1,129 @@
+"""Aggregate Google unigram counts into counts.txt (and its lexicon).
+
+Shards are parsed in parallel. Each worker writes its partial counts to
+sorted spill files, which are merged in one pass at the end, so memory use
+does not grow with the number of shards.
+"""
+
+import argparse
 import collections
 import glob
 import gzip
+import heapq
+import multiprocessing
+import os
+import tempfile
 import tqdm
 
+import scc_lexicon_lib
+
 YEAR_CUTOFF = 1980
+MIN_COUNT = 100
+SPILL_SIZE = 5000000  # Distinct tokens a worker holds before spilling
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument('-u',
+                    '--unigram_path',
+                    default="/gypsum/work1/mccallum/nnayak/google_unigrams/",
+                    type=str,
+                    help='directory of gzipped unigram shards')
+parser.add_argument('-o', '--output_file', default='counts.txt', type=str)
+parser.add_argument('-n',
+                    '--num_workers',
+                    default=os.cpu_count(),
+                    type=int,
+                    help='number of shards parsed in parallel')
+parser.add_argument('-s',
+                    '--spill_directory',
+                    default=None,
+                    type=str,
+                    help='directory for partial counts (default: a temporary '
+                    'directory)')
+
+
+def lowercase(token):
+    if token.isascii():
+        return token.lower()
+    return token.decode().lower().encode()
+
+
+def spill(counts, spill_filename):
+    with open(spill_filename, 'wb') as f:
+        for token, count in sorted(counts.items()):
+            f.write(b"%s\t%d\n" % (token, count))
+
+
+def count_shard(shard_filename, spill_prefix):
+    """Count lowercased tokens from YEAR_CUTOFF on in one shard.
+
+    Returns the names of the sorted spill files holding the counts.
+    """
+    year_cutoff = b"%d" % YEAR_CUTOFF
+    counts = collections.Counter()
+    spill_filenames = []
+    with gzip.open(shard_filename, 'rb') as f:
+        for line in f:
+            token, year, count, _ = line.split(b"\t")
+            # Years are all four digits, so they compare correctly as bytes
+            if year < year_cutoff or not token.strip():
+                continue
+            counts[lowercase(token)] += int(count)
+            if len(counts) >= SPILL_SIZE:
+                spill_filenames.append(
+                    f'{spill_prefix}.{len(spill_filenames)}')
+                spill(counts, spill_filenames[-1])
+                counts.clear()
+    if counts:
+        spill_filenames.append(f'{spill_prefix}.{len(spill_filenames)}')
+        spill(counts, spill_filenames[-1])
+    return spill_filenames
+
+
+def _count_shard(args):
+    return count_shard(*args)
+
+
+def read_spill(spill_filename):
+    with open(spill_filename, 'rb') as f:
+        for line in f:
+            token, count = line.rstrip(b"\n").split(b"\t")
+            yield token, int(count)
+
+
+def merge_spills(spill_filenames, output_file):
+    """Sum the counts of each token across sorted spill files and write the
+    tokens with at least MIN_COUNT occurrences."""
+    merged = heapq.merge(*[read_spill(s) for s in spill_filenames])
+    with open(output_file, 'w') as g:
+        current_token, current_count = None, 0
+        for token, count in merged:
+            if token != current_token:
+                if current_count >= MIN_COUNT:
+                    g.write(f'{current_token.decode()}\t{current_count}\n')
+                current_token, current_count = token, 0
+            current_count += count
+        if current_count >= MIN_COUNT:
+            g.write(f'{current_token.decode()}\t{current_count}\n')
 
 
 def main():
+    args = parser.parse_args()
+
+    shard_filenames = sorted(glob.glob(f'{args.unigram_path}*.gz'))
+    with tempfile.TemporaryDirectory(dir=args.spill_directory) as spill_dir:
+        tasks = [(shard_filename, f'{spill_dir}/{i}')
+                 for i, shard_filename in enumerate(shard_filenames)]
+        spill_filenames = []
+        with multiprocessing.Pool(args.num_workers) as pool:
+            results = pool.imap_unordered(_count_shard, tasks)
+            for shard_spill_filenames in tqdm.tqdm(results, total=len(tasks)):
+                spill_filenames += shard_spill_filenames
+        merge_spills(spill_filenames, args.output_file)
 
-    UNIGRAM_PATH = "/gypsum/work1/mccallum/nnayak/google_unigrams/"
-    with open('counts.txt', 'w') as g:
-        for filename in tqdm.tqdm(
-                sorted(list(glob.glob(f'{UNIGRAM_PATH}*.gz')))):
-            counts = collections.Counter()
-            with gzip.open(filename, 'rb') as f:
-                for line in f:
-                    token, year, count, _ = line.split(b"\t")
-                    if not token.strip():
-                        continue
-                    if int(year) >= YEAR_CUTOFF:
-                        counts[token.decode().lower()] += int(count)
-
-            for token, count in counts.most_common():
-                if count < 100:
-                    break
-                g.write(f'{token}\t{count}\n')
+    # Lookups (02_new_categorize.py) go through the memory-mapped lexicon
+    scc_lexicon_lib.build_lexicon(
+        scc_lexicon_lib.read_counts(args.output_file),
+        scc_lexicon_lib.get_lexicon_filename(args.output_file))
 
 
 if __name__ == "__main__":
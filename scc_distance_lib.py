@@ -0,0 +1,77 @@
+"""Bounded edit distance for typo classification.
+
+The categorizers only need to know whether the Levenshtein distance between
+two strings is below a small threshold. Computing the full dynamic programming
+matrix (as nltk's edit_distance does) costs O(len(a) * len(b)); restricting it
+to a band around the diagonal and stopping as soon as the threshold is
+unreachable costs O(min(len(a), len(b)) * bound) at most.
+"""
+
+
+def bounded_edit_distance(a, b, bound):
+    """Levenshtein distance between a and b if it is below bound, else bound.
+
+    Costs are the same as nltk's edit_distance with default arguments.
+    """
+    # Common prefix and suffix do not change the distance
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < len(a) - prefix and suffix < len(b) - prefix
+           and a[-1 - suffix] == b[-1 - suffix]):
+        suffix += 1
+    a = a[prefix:len(a) - suffix]
+    b = b[prefix:len(b) - suffix]
+
+    if len(a) > len(b):
+        a, b = b, a
+    n, m = len(a), len(b)
+    if m - n >= bound:
+        return bound
+    if not n:
+        return m
+
+    # Only cells with |i - j| <= max_distance can lie on a path of cost below
+    # bound. Cells outside the band are treated as having cost bound.
+    max_distance = bound - 1
+    previous = [min(j, bound) for j in range(m + 1)]
+    current = [bound] * (m + 1)
+    for i in range(1, n + 1):
+        lo = max(1, i - max_distance)
+        hi = min(m, i + max_distance)
+        current[lo - 1] = i if lo == 1 else bound
+        row_min = current[lo - 1]
+        for j in range(lo, hi + 1):
+            cost = min(previous[j - 1] + (a[i - 1] != b[j - 1]),
+                       previous[j] + 1, current[j - 1] + 1, bound)
+            current[j] = cost
+            if cost < row_min:
+                row_min = cost
+        if hi < m:
+            current[hi + 1] = bound
+        if row_min >= bound:
+            return bound
+        previous, current = current, previous
+
+    return min(previous[m], bound)
+
+
+def is_within_edit_distance(a, b, bound):
+    """Whether the Levenshtein distance between a and b is below bound."""
+    return bounded_edit_distance(a, b, bound) < bound
+
+
+def bounded_edit_distances(pairs, bound):
+    """bounded_edit_distance for each (a, b) pair.
+
+    Repeated pairs, which are common (e.g. the same ligature fix across many
+    diffs), are only computed once.
+    """
+    distances = {}
+    results = []
+    for a, b in pairs:
+        if (a, b) not in distances:
+            distances[a, b] = bounded_edit_distance(a, b, bound)
+        results.append(distances[a, b])
+    return results
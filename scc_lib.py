@@ -1,7 +1,16 @@
+import bisect
 import collections
+import concurrent.futures
+import glob
+import itertools
 import json
+import os
+import socket
+import zlib
 
-from nltk.metrics.distance import edit_distance
+import scc_distance_lib
+import scc_storage_lib
+import scc_store_lib
 
 
 class Conference(object):
@@ -49,6 +58,8 @@ class Stage(object):
     EXTRACT = "extract"
     COMPUTE = "compute"
 
+    ALL = [DOWNLOAD, EXTRACT, COMPUTE]
+
 
 def read_jsonl(filename):
     try:
@@ -58,6 +69,16 @@ def read_jsonl(filename):
         return []
 
 
+def iter_jsonl(filename):
+    """Like read_jsonl, one line at a time."""
+    try:
+        with open(filename, 'r') as f:
+            for l in f:
+                yield json.loads(l)
+    except FileNotFoundError:
+        return
+
+
 # == Records helpers ==========================================================
 
 
@@ -65,6 +86,28 @@ def get_record_filename(record_directory, conference, data_stage):
     return f'{record_directory}/{data_stage}_record_{conference}.jsonl'
 
 
+def get_shard_record_filename(record_directory, conference, data_stage,
+                              shard_name):
+    return (f'{record_directory}/{data_stage}_record_{conference}'
+            f'.shard_{shard_name}.jsonl')
+
+
+def get_shard_record_filenames(record_directory, conference, data_stage):
+    """Record files of sharded runs that have not been merged yet."""
+    return sorted(
+        glob.glob(f'{record_directory}/{data_stage}_record_{conference}'
+                  '.shard_*.jsonl'))
+
+
+def iter_records(record_directory, conference, data_stage):
+    """Records of a stage, including those of unmerged sharded runs."""
+    yield from iter_jsonl(
+        get_record_filename(record_directory, conference, data_stage))
+    for filename in get_shard_record_filenames(record_directory, conference,
+                                               data_stage):
+        yield from iter_jsonl(filename)
+
+
 #def get_records(record_directory, conference, data_stage):
 #    return read_jsonl(
 #        get_record_filename(record_directory, conference, data_stage))
@@ -77,8 +120,7 @@ def get_records(record_directory,
                 stage,
                 complete_only=False,
                 full_records=False):
-    records = read_jsonl(
-        get_record_filename(record_directory, conference, stage))
+    records = list(iter_records(record_directory, conference, stage))
     if complete_only:
         records = [r for r in records if r['status'] == 'complete']
     if full_records:
@@ -92,37 +134,148 @@ def write_record(record, file_handle):
     file_handle.flush()
 
 
-# == Helpers for filenames ====================================================
-
-
-class FileCategories(object):
-    METADATA = "metadata"
-    INITIAL = "initial"
-    FINAL = "final"
-    TEXTS = "texts"
-    ABSTRACT = "abstract"
-    INTRO = "intro"
-
-    ALL = [METADATA, INITIAL, FINAL, TEXTS, ABSTRACT, INTRO]
-
-
-LatmodFilenames = collections.namedtuple("LatmodFilenames", FileCategories.ALL)
-
-FILENAMES = {
-    FileCategories.METADATA: "metadata.json",
-    FileCategories.INITIAL: "initial.pdf",
-    FileCategories.FINAL: "final.pdf",
-    FileCategories.TEXTS: "texts.json",
-    FileCategories.ABSTRACT: "diffs_abstract.json",
-    FileCategories.INTRO: "diffs_intro.json",
-}
-
-
-def get_filenames(data_directory, conference, forum):
-    return LatmodFilenames(*[
-        f'{data_directory}/{conference}/{forum}/{FILENAMES[filecat]}'
-        for filecat in FileCategories.ALL
-    ])
+# == Sharding =================================================================
+
+
+def add_shard_arguments(parser):
+    """Options for splitting a stage's forums across tasks, e.g. the tasks of
+    a SLURM array."""
+    parser.add_argument('--num_shards',
+                        default=1,
+                        type=int,
+                        help='number of tasks sharing the forums')
+    parser.add_argument('--shard_index',
+                        default=0,
+                        type=int,
+                        help='index of this task, from 0 to num_shards - 1')
+    parser.add_argument('--claim_directory',
+                        default=None,
+                        type=str,
+                        help=('claim forums in this directory as they are '
+                              'processed, instead of assigning them by hash'))
+
+
+def get_shard(forum_id, num_shards):
+    """Stable across runs and machines, unlike hash()."""
+    return zlib.crc32(forum_id.encode()) % num_shards
+
+
+class WorkShard(object):
+    """The forums of a conference processed by one task in one stage.
+
+    Forums are assigned to tasks by a hash of their id or, with a claim
+    directory, to the first task that creates the forum's claim file (so
+    that tasks finishing early take over remaining forums). Claims are not
+    released; remove the claim directory to retry unfinished forums.
+
+    A sharded task writes its own record file, which merge_records.py merges
+    into the stage's record file. In claim mode, the file is named by host
+    and process, since all tasks may share a shard index.
+    """
+
+    def __init__(self,
+                 conference,
+                 stage,
+                 num_shards=1,
+                 shard_index=0,
+                 claim_directory=None):
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f'Shard index {shard_index} not in '
+                             f'[0, {num_shards})')
+        self.conference = conference
+        self.stage = stage
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.claim_directory = None
+        if claim_directory is not None:
+            self.claim_directory = f'{claim_directory}/{stage}_{conference}'
+            os.makedirs(self.claim_directory, exist_ok=True)
+
+    def is_sharded(self):
+        return self.num_shards > 1 or self.claim_directory is not None
+
+    def record_filename(self, record_directory):
+        if not self.is_sharded():
+            return get_record_filename(record_directory, self.conference,
+                                       self.stage)
+        if self.claim_directory is None:
+            shard_name = f'{self.shard_index:04d}'
+        else:
+            shard_name = f'claim_{socket.gethostname()}_{os.getpid()}'
+        return get_shard_record_filename(record_directory, self.conference,
+                                         self.stage, shard_name)
+
+    def owns(self, forum_id):
+        """Whether this task should process the forum. With a claim
+        directory, this claims the forum, so only call it for forums that
+        are about to be processed."""
+        if self.claim_directory is None:
+            return get_shard(forum_id, self.num_shards) == self.shard_index
+        try:
+            # O_EXCL creation is atomic, also on NFS (v3 and later)
+            os.close(
+                os.open(f'{self.claim_directory}/{forum_id}',
+                        os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+
+def get_work_shard(args, stage):
+    return WorkShard(args.conference, stage, args.num_shards,
+                     args.shard_index, args.claim_directory)
+
+
+# == Token alignment ==========================================================
+
+
+class TokenAlignment(object):
+    """Map from source token indices to dest token indices.
+
+    Source tokens that were removed or changed are not aligned.
+    """
+
+    def __init__(self, alignment):
+        self.alignment = alignment  # dest index per source index, or -1
+
+    def dest_index(self, source_index):
+        dest_index = self.alignment[source_index]
+        return None if dest_index == -1 else dest_index
+
+    def map_span(self, start, end):
+        """Dest span covering the aligned tokens of source span [start, end).
+
+        Returns None if no token in the span is aligned.
+        """
+        aligned = [j for j in self.alignment[start:end] if j != -1]
+        if not aligned:
+            return None
+        return aligned[0], aligned[-1] + 1
+
+
+def get_token_alignment(obj):
+    """Get the TokenAlignment of a loaded diff file.
+
+    Files written before alignments were persisted get it rebuilt from their
+    diffs.
+    """
+    if 'alignment' in obj:
+        return TokenAlignment(obj['alignment'])
+
+    alignment = []
+    source_cursor = 0
+    dest_cursor = 0
+    for diff in obj['diffs']:
+        alignment += range(dest_cursor,
+                           dest_cursor + diff['old_index'] + 1 - source_cursor)
+        old_len = sum(len(old_string) for old_string in diff['old_tokens'])
+        new_len = sum(len(new_string) for new_string in diff['new_tokens'])
+        alignment += [-1] * old_len
+        source_cursor = diff['old_index'] + 1 + old_len
+        dest_cursor = diff['new_index'] + 1 + new_len
+    source_len = sum(len(sentence) for sentence in obj['tokens']['source'])
+    alignment += range(dest_cursor, dest_cursor + source_len - source_cursor)
+    return TokenAlignment(alignment)
 
 
 # == Categorizing diffs
@@ -148,20 +301,73 @@ class DiffScope(object):
     MULTI_SENTENCE = "multi_sentence"
 
 
-def compute_sentence_ranges(sentences):
-    tokens_seen = 0
-    sentence_ranges = []
-    for sentence in sentences:
-        end = tokens_seen + len(sentence)
-        sentence_ranges.append(range(tokens_seen, end))
-        tokens_seen = end
-
-    return sentence_ranges
-
-
-def get_diff_type(diff):
-    if abs(edit_distance("".join(diff['old']),
-                         "".join(diff['new']))) < TYPO_EDIT_DISTANCE:
+class SentenceIndex(object):
+    """Sentence lookups for flat token indices of a sentence-split document.
+
+    Built once per document; each lookup bisects the sentence start offsets.
+    """
+
+    def __init__(self, sentences):
+        self.offsets = scc_store_lib.get_sentence_offsets(sentences)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_tokens(self):
+        return self.offsets[-1]
+
+    def sentence_of(self, index):
+        """Index of the sentence containing token index, or None."""
+        if not 0 <= index < self.num_tokens:
+            return None
+        return bisect.bisect_right(self.offsets, index) - 1
+
+    def span(self, sentence_index):
+        """Token span [start, end) of a sentence."""
+        return (self.offsets[sentence_index],
+                self.offsets[sentence_index + 1])
+
+    def spans(self):
+        return zip(self.offsets[:-1], self.offsets[1:])
+
+    def is_within_sentence(self, start, end):
+        """Whether the non-empty token span [start, end) is in one sentence."""
+        sentence_index = self.sentence_of(start)
+        assert sentence_index is not None
+        return end <= self.offsets[sentence_index + 1]
+
+
+def get_categorizable_diff(diff, source_tokens, dest_tokens):
+    """Convert a diff as written by the compute stage (old_index, new_index,
+    old_tokens, new_tokens) into the flat index/old/new form used below.
+    new_index is the dest index of the first token of new.
+
+    Pure insertions keep their anchor token in both old and new, so that they
+    can be recognized as insertions.
+    """
+    old = [token for old_string in diff['old_tokens'] for token in old_string]
+    new = [token for new_string in diff['new_tokens'] for token in new_string]
+    if not old and diff['old_index'] != -1:
+        return {
+            'index': diff['old_index'],
+            'new_index': diff['new_index'],
+            'old': [source_tokens[diff['old_index']]],
+            'new': [dest_tokens[diff['new_index']]] + new
+        }
+    return {
+        'index': diff['old_index'] + 1,
+        'new_index': diff['new_index'] + 1,
+        'old': old,
+        'new': new
+    }
+
+
+def get_diff_type(diff, is_typo=None):
+    if is_typo is None:
+        is_typo = scc_distance_lib.is_within_edit_distance(
+            "".join(diff['old']), "".join(diff['new']), TYPO_EDIT_DISTANCE)
+    if is_typo:
         return DiffType.TYPO
     elif not diff['new']:
         return DiffType.DELETE
@@ -171,38 +377,184 @@ def get_diff_type(diff):
         return DiffType.MODIFY
 
 
-def is_in_sentence(diff, sentence_ranges, skip_first=False):
+def is_in_sentence(diff, sentence_index, skip_first=False):
     index = diff['index']
     if skip_first:
         index += 1
-    if index == sentence_ranges[-1].stop:  # A sentence is being appended
+    if index == sentence_index.num_tokens:  # A sentence is being appended
         assert skip_first
         return True
-    for r in sentence_ranges:
-        if index in r:
-            if index + len(diff['old']) in r:
-                return True
-            else:
-                return False
-    assert False
+    # The token after the changed ones has to be in the same sentence too
+    return sentence_index.is_within_sentence(index,
+                                             index + len(diff['old']) + 1)
 
 
-def get_diff_type_and_scope(diff, sentence_ranges):
+def get_diff_type_and_scope(diff, sentence_index, is_typo=None):
 
-    diff_type = get_diff_type(diff)
+    diff_type = get_diff_type(diff, is_typo)
 
     scope = None
     diff_len = (len(diff['old']), len(diff['new']))
     if diff_len in TOKEN_DIFF_LENS:
         scope = DiffScope.TOKEN
-    elif is_in_sentence(diff, sentence_ranges):
+    elif is_in_sentence(diff, sentence_index):
         scope = DiffScope.IN_SENTENCE
     else:
         if diff_type == DiffType.INSERT and is_in_sentence(
-                diff, sentence_ranges, skip_first=True):
+                diff, sentence_index, skip_first=True):
             scope = DiffScope.IN_SENTENCE
         else:
             scope = DiffScope.MULTI_SENTENCE
     assert scope is not None
 
     return diff_type, scope
+
+
+def get_diff_types_and_scopes(diffs, sentence_index):
+    """get_diff_type_and_scope for each diff, with edit distances computed in
+    one batch."""
+    distances = scc_distance_lib.bounded_edit_distances(
+        [("".join(diff['old']), "".join(diff['new'])) for diff in diffs],
+        TYPO_EDIT_DISTANCE)
+    return [
+        get_diff_type_and_scope(diff,
+                                sentence_index,
+                                is_typo=distance < TYPO_EDIT_DISTANCE)
+        for diff, distance in zip(diffs, distances)
+    ]
+
+
+def get_document_categories(obj):
+    """(type, scope) of each diff of a diff file object (as written by
+    DocumentDiff.dump).
+
+    Like the compute stage, diffs against an empty source (a part that only
+    exists in the dest version) are not categorized; they get (None, None).
+    """
+    source_tokens = list(itertools.chain.from_iterable(
+        obj['tokens']['source']))
+    if not source_tokens:
+        return [(None, None)] * len(obj['diffs'])
+    dest_tokens = list(itertools.chain.from_iterable(obj['tokens']['dest']))
+    return get_diff_types_and_scopes([
+        get_categorizable_diff(d, source_tokens, dest_tokens)
+        if 'old_index' in d else d for d in obj['diffs']
+    ], SentenceIndex(obj['tokens']['source']))
+
+
+# == Corpus queries ===========================================================
+
+Forum = collections.namedtuple(
+    "Forum", "conference forum_id status decision storage".split())
+Section = collections.namedtuple("Section",
+                                 "forum part source dest status name".split())
+SectionDiff = collections.namedtuple("SectionDiff", "section diff".split())
+
+
+def _allowed(value, allowed_values):
+    return allowed_values is None or value in allowed_values
+
+
+def load_section(section):
+    """The diff file object of a section, as written by DocumentDiff.dump."""
+    return scc_store_lib.load_document_diff(section.forum.storage,
+                                            section.forum.forum_id,
+                                            section.name)
+
+
+class CorpusQuery(object):
+    """Lazily iterate over forums, diffed sections and diffs.
+
+    Each filter is a collection of allowed values, or None for no filtering:
+        conferences, decisions, statuses (download stage status)
+        parts, pairs ((source, dest) tuples), section_statuses (compute
+        stage status)
+
+    Records are read one conference at a time, and diff files are only
+    loaded by documents() and diffs(). With prefetch > 0, that many diff
+    files are loaded ahead on a thread pool.
+    """
+
+    def __init__(self,
+                 data_directory,
+                 record_directory,
+                 conferences=None,
+                 decisions=None,
+                 statuses=(DownloadStatus.COMPLETE, ),
+                 parts=None,
+                 pairs=None,
+                 section_statuses=("complete", ),
+                 prefetch=0):
+        self.data_directory = data_directory
+        self.record_directory = record_directory
+        self.conferences = (Conference.ALL
+                            if conferences is None else conferences)
+        self.decisions = decisions
+        self.statuses = statuses
+        self.parts = parts
+        self.pairs = None if pairs is None else set(map(tuple, pairs))
+        self.section_statuses = section_statuses
+        self.prefetch = prefetch
+
+    def _conference_forums(self, conference):
+        storage = scc_storage_lib.open_storage(self.data_directory,
+                                               conference)
+        for record in iter_records(self.record_directory, conference,
+                                   Stage.DOWNLOAD):
+            if (_allowed(record['status'], self.statuses)
+                    and _allowed(record['decision'], self.decisions)):
+                yield Forum(conference, record['forum_id'], record['status'],
+                            record['decision'], storage)
+
+    def forums(self):
+        for conference in self.conferences:
+            yield from self._conference_forums(conference)
+
+    def sections(self):
+        """Diffed sections of the selected forums that have a diff file."""
+        for conference in self.conferences:
+            forums = {
+                forum.forum_id: forum
+                for forum in self._conference_forums(conference)
+            }
+            for record in iter_records(self.record_directory, conference,
+                                       Stage.COMPUTE):
+                forum = forums.get(record['forum_id'])
+                if (forum is None
+                        or not _allowed(record['status'],
+                                        self.section_statuses)
+                        or not _allowed(record['part'], self.parts)
+                        or not _allowed((record['source'], record['dest']),
+                                        self.pairs)):
+                    continue
+                name = scc_store_lib.find_diffs_name(forum.storage,
+                                                     forum.forum_id,
+                                                     record['part'],
+                                                     record['source'],
+                                                     record['dest'])
+                if name is not None:
+                    yield Section(forum, record['part'], record['source'],
+                                  record['dest'], record['status'], name)
+
+    def documents(self):
+        """(section, diff file object) for each section, in order."""
+        if not self.prefetch:
+            for section in self.sections():
+                yield section, load_section(section)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(self.prefetch) as pool:
+            window = collections.deque()
+            for section in self.sections():
+                window.append((section, pool.submit(load_section, section)))
+                if len(window) > self.prefetch:
+                    section, future = window.popleft()
+                    yield section, future.result()
+            while window:
+                section, future = window.popleft()
+                yield section, future.result()
+
+    def diffs(self):
+        for section, obj in self.documents():
+            for diff in obj['diffs']:
+                yield SectionDiff(section, diff)
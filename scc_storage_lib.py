@@ -0,0 +1,238 @@
+"""Storage of per-forum artifacts (metadata, PDFs, texts, tokens, diffs).
+
+Two layouts are supported, chosen per conference:
+
+    directory  {data_dir}/{conference}/{forum_id}/{name}, one file per
+               artifact (the original layout)
+    packed     {data_dir}/{conference}/packed/{artifact_type}.seg, an
+               append-only segment file per artifact type, with an index
+               ({artifact_type}.idx, one "forum_id name offset length" line
+               per artifact) for random access by forum id
+
+Packed storage avoids tens of thousands of small files per conference on
+shared network filesystems. pack_data.py converts a conference from the
+directory layout. Code using either layout goes through open_storage.
+"""
+
+import contextlib
+import fcntl
+import io
+import os
+import shutil
+import tempfile
+
+
+class Layout(object):
+    DIRECTORY = "directory"
+    PACKED = "packed"
+    ALL = [DIRECTORY, PACKED]
+
+
+PACKED_DIRECTORY = "packed"
+
+
+def get_artifact_type(name):
+    """Artifacts of the same type share a segment file in packed storage."""
+    if name.endswith(".pdf"):
+        return "pdfs"
+    for prefix in ["diffs", "tokens"]:
+        if name.startswith(f'{prefix}_'):
+            return prefix
+    return os.path.splitext(name)[0]  # metadata, texts
+
+
+def get_layout(data_directory, conference):
+    if os.path.isdir(f'{data_directory}/{conference}/{PACKED_DIRECTORY}'):
+        return Layout.PACKED
+    return Layout.DIRECTORY
+
+
+def open_storage(data_directory, conference, layout=None):
+    """Storage of one conference. The layout is detected if not given."""
+    if layout is None:
+        layout = get_layout(data_directory, conference)
+    if layout == Layout.PACKED:
+        return PackedStorage(data_directory, conference)
+    return DirectoryStorage(data_directory, conference)
+
+
+# == Directory layout =========================================================
+
+
+class DirectoryStorage(object):
+
+    def __init__(self, data_directory, conference):
+        self.conference_directory = f'{data_directory}/{conference}'
+
+    def forum_directory(self, forum_id):
+        return f'{self.conference_directory}/{forum_id}'
+
+    def open(self, forum_id, name, mode='r'):
+        if 'r' not in mode:
+            os.makedirs(self.forum_directory(forum_id), exist_ok=True)
+        return open(f'{self.forum_directory(forum_id)}/{name}', mode)
+
+    def exists(self, forum_id, name):
+        return os.path.exists(f'{self.forum_directory(forum_id)}/{name}')
+
+    def forum_ids(self):
+        if not os.path.isdir(self.conference_directory):
+            return []
+        return sorted(f for f in os.listdir(self.conference_directory)
+                      if f != PACKED_DIRECTORY and os.path.isdir(
+                          f'{self.conference_directory}/{f}'))
+
+    def names(self, forum_id):
+        if not os.path.isdir(self.forum_directory(forum_id)):
+            return []
+        return sorted(os.listdir(self.forum_directory(forum_id)))
+
+    @contextlib.contextmanager
+    def local_path(self, forum_id, name):
+        """Path of an artifact on the local filesystem, for external tools."""
+        yield f'{self.forum_directory(forum_id)}/{name}'
+
+
+# == Packed layout ============================================================
+
+# Indices are loaded once per process. When an index grows, only the lines
+# appended since it was loaded are read.
+_index_cache = {}  # {index_filename: (bytes indexed, index)}
+
+
+def _parse_index_lines(data, index):
+    for line in data.decode('utf-8').splitlines():
+        forum_id, name, offset, length = line.split()
+        index.setdefault(forum_id, {})[name] = (int(offset), int(length))
+
+
+def _read_index(index_filename):
+    """{forum_id: {name: (offset, length)}}; later entries win."""
+    size = os.path.getsize(index_filename) if os.path.exists(
+        index_filename) else 0
+    indexed_size, index = _index_cache.get(index_filename, (0, None))
+    if index is None or size < indexed_size:
+        # Not loaded yet, or replaced by a smaller file
+        indexed_size, index = 0, {}
+    if size > indexed_size:
+        with open(index_filename, 'rb') as f:
+            data = os.pread(f.fileno(), size - indexed_size, indexed_size)
+        # The last line may still be being appended by another writer
+        data = data[:data.rfind(b'\n') + 1]
+        _parse_index_lines(data, index)
+        indexed_size += len(data)
+    _index_cache[index_filename] = (indexed_size, index)
+    return index
+
+
+def _add_to_index(index_filename, index_offset, line):
+    """Add a line just appended at index_offset to the cached index, if the
+    cache was up to date with the index file before the append."""
+    indexed_size, index = _index_cache.get(index_filename, (0, None))
+    if index is not None and indexed_size == index_offset:
+        _parse_index_lines(line, index)
+        _index_cache[index_filename] = (indexed_size + len(line), index)
+
+
+class _PackedWriter(io.BytesIO):
+    """Buffers an artifact and appends it to its segment when closed."""
+
+    def __init__(self, storage, forum_id, name):
+        super().__init__()
+        self._storage = storage
+        self._forum_id = forum_id
+        self._name = name
+
+    def close(self):
+        if not self.closed:
+            self._storage.write_bytes(self._forum_id, self._name,
+                                      self.getvalue())
+        super().close()
+
+
+class PackedStorage(object):
+
+    def __init__(self, data_directory, conference):
+        self.packed_directory = (
+            f'{data_directory}/{conference}/{PACKED_DIRECTORY}')
+
+    def _filenames(self, name):
+        prefix = f'{self.packed_directory}/{get_artifact_type(name)}'
+        return f'{prefix}.seg', f'{prefix}.idx'
+
+    def _location(self, forum_id, name):
+        _, index_filename = self._filenames(name)
+        return _read_index(index_filename).get(forum_id, {}).get(name)
+
+    def read_bytes(self, forum_id, name):
+        location = self._location(forum_id, name)
+        if location is None:
+            raise FileNotFoundError(f'{forum_id}/{name} not in '
+                                    f'{self.packed_directory}')
+        offset, length = location
+        segment_filename, _ = self._filenames(name)
+        with open(segment_filename, 'rb') as f:
+            return os.pread(f.fileno(), length, offset)
+
+    def write_bytes(self, forum_id, name, data):
+        """Append an artifact. Writers (e.g. shards of a stage) are
+        serialized by a lock on the segment file."""
+        os.makedirs(self.packed_directory, exist_ok=True)
+        segment_filename, index_filename = self._filenames(name)
+        with open(segment_filename, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+                f.flush()
+                line = f'{forum_id}\t{name}\t{offset}\t{len(data)}\n'.encode()
+                with open(index_filename, 'ab') as g:
+                    index_offset = g.seek(0, os.SEEK_END)
+                    g.write(line)
+                _add_to_index(index_filename, index_offset, line)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def open(self, forum_id, name, mode='r'):
+        if 'r' in mode:
+            f = io.BytesIO(self.read_bytes(forum_id, name))
+        else:
+            f = _PackedWriter(self, forum_id, name)
+        return f if 'b' in mode else io.TextIOWrapper(f, encoding='utf-8')
+
+    def exists(self, forum_id, name):
+        return self._location(forum_id, name) is not None
+
+    def _indices(self):
+        if not os.path.isdir(self.packed_directory):
+            return []
+        return [
+            _read_index(f'{self.packed_directory}/{f}')
+            for f in sorted(os.listdir(self.packed_directory))
+            if f.endswith(".idx")
+        ]
+
+    def forum_ids(self):
+        return sorted(set().union(*self._indices()))
+
+    def names(self, forum_id):
+        return sorted(name for index in self._indices()
+                      for name in index.get(forum_id, {}))
+
+    @contextlib.contextmanager
+    def local_path(self, forum_id, name):
+        """Path of an artifact on the local filesystem, for external tools.
+
+        Packed artifacts are copied to a temporary file.
+        """
+        with tempfile.TemporaryDirectory() as temp_directory:
+            path = f'{temp_directory}/{name}'
+            with open(path, 'wb') as f:
+                f.write(self.read_bytes(forum_id, name))
+            yield path
+
+
+def copy_artifact(source_storage, dest_storage, forum_id, name):
+    with source_storage.open(forum_id, name, 'rb') as f:
+        with dest_storage.open(forum_id, name, 'wb') as g:
+            shutil.copyfileobj(f, g)
@@ -0,0 +1,260 @@
+"""Compact binary (.npz) storage for tokens and diffs.
+
+The tokens of each (forum, version, part) are written once, to a token store
+with interned token ids. Diff files only hold indices into the flat token
+sequences of their source and destination stores, so diffs can be loaded
+without loading any tokens.
+
+Writers and loaders take open binary file objects; files are named and opened
+through a forum's storage (scc_storage_lib).
+"""
+
+import bisect
+import collections
+import itertools
+import json
+
+import numpy as np
+
+# Bumped when an array is removed or changes meaning. Arrays added since
+# version 1 (alignment, sentence pairs, categories) are optional when loading.
+FORMAT_VERSION = 1
+
+
+class OutputFormat(object):
+    JSON = "json"
+    BINARY = "binary"
+    ALL = [JSON, BINARY]
+
+
+BinaryDiffs = collections.namedtuple(
+    "BinaryDiffs", ("part source dest old_index new_index old_lengths "
+                    "new_lengths alignment old_sentence new_sentence "
+                    "diff_type diff_scope").split())
+
+
+def get_token_store_name(part, version):
+    return f'tokens_{part}_{version}.npz'
+
+
+def get_diffs_name(part, source, dest, output_format):
+    extension = "npz" if output_format == OutputFormat.BINARY else "json"
+    return f'diffs_{part}_{source}_{dest}.{extension}'
+
+
+def find_diffs_name(storage, forum_id, part, source, dest):
+    """Name of the existing diff file for a pair, in either format, or None."""
+    for output_format in [OutputFormat.BINARY, OutputFormat.JSON]:
+        name = get_diffs_name(part, source, dest, output_format)
+        if storage.exists(forum_id, name):
+            return name
+    return None
+
+
+def _check_version(arrays):
+    if int(arrays['format_version']) != FORMAT_VERSION:
+        raise ValueError(f'Format version {int(arrays["format_version"])}, '
+                         f'expected {FORMAT_VERSION}')
+
+
+# == Sentence offsets =========================================================
+
+
+def get_sentence_offsets(unflat_tokens):
+    """Sentence k covers flat token indices offsets[k] to offsets[k + 1]."""
+    return list(
+        itertools.accumulate((len(sentence) for sentence in unflat_tokens),
+                             initial=0))
+
+
+def split_into_sentences(tokens, start, end, sentence_offsets):
+    """Split the flat tokens[start:end] at sentence boundaries."""
+    split_tokens = []
+    # Last sentence starting at or before start; this skips empty sentences
+    sentence_index = bisect.bisect_right(sentence_offsets, start) - 1
+    while start < end:
+        sentence_end = min(sentence_offsets[sentence_index + 1], end)
+        if sentence_end > start:
+            split_tokens.append(tokens[start:sentence_end])
+        start = sentence_end
+        sentence_index += 1
+    return split_tokens
+
+
+# == Token stores =============================================================
+
+
+def write_token_store(f, unflat_tokens):
+    vocabulary = {}
+    token_ids = [
+        vocabulary.setdefault(token, len(vocabulary))
+        for sentence in unflat_tokens for token in sentence
+    ]
+    encoded_vocabulary = [token.encode() for token in vocabulary]
+    np.savez_compressed(
+        f,
+        format_version=np.array(FORMAT_VERSION),
+        vocabulary_bytes=np.frombuffer(b"".join(encoded_vocabulary),
+                                       dtype=np.uint8),
+        vocabulary_offsets=np.array(list(
+            itertools.accumulate((len(t) for t in encoded_vocabulary),
+                                 initial=0)),
+                                    dtype=np.int64),
+        token_ids=np.array(token_ids, dtype=np.uint32),
+        sentence_offsets=np.array(get_sentence_offsets(unflat_tokens),
+                                  dtype=np.int64))
+
+
+def load_tokens(f):
+    """Load the sentence-split tokens of a token store."""
+    with np.load(f) as arrays:
+        _check_version(arrays)
+        vocabulary_bytes = arrays['vocabulary_bytes'].tobytes()
+        vocabulary_offsets = arrays['vocabulary_offsets'].tolist()
+        token_ids = arrays['token_ids'].tolist()
+        sentence_offsets = arrays['sentence_offsets'].tolist()
+
+    vocabulary = [
+        vocabulary_bytes[start:end].decode()
+        for start, end in zip(vocabulary_offsets[:-1], vocabulary_offsets[1:])
+    ]
+    tokens = [vocabulary[token_id] for token_id in token_ids]
+    return [
+        tokens[start:end]
+        for start, end in zip(sentence_offsets[:-1], sentence_offsets[1:])
+    ]
+
+
+# == Diffs ====================================================================
+
+
+def write_diffs(f,
+                part,
+                source,
+                dest,
+                diffs,
+                alignment,
+                sentence_pairs=None,
+                categories=None):
+    """Write diffs (scc_diff_lib.Diff with sentence-split tokens) as indices.
+
+    alignment maps each source token index to a dest token index, or -1.
+
+    Sentence pairs (from hierarchical diffing) are optional; None is stored as
+    -1. Categories ((type, scope) per diff) are optional too.
+    """
+    sentence_pair_arrays = {}
+    if sentence_pairs is not None:
+        for field in ['old_sentence', 'new_sentence']:
+            indices = [getattr(p, field) for p in sentence_pairs]
+            sentence_pair_arrays[field] = np.array(
+                [-1 if i is None else i for i in indices], dtype=np.int64)
+    category_arrays = {}
+    if categories is not None:
+        category_arrays['diff_type'] = np.array([t for t, _ in categories],
+                                                dtype=str)
+        category_arrays['diff_scope'] = np.array([s for _, s in categories],
+                                                 dtype=str)
+    np.savez_compressed(
+        f,
+        **sentence_pair_arrays,
+        **category_arrays,
+        format_version=np.array(FORMAT_VERSION),
+        part=np.array(part),
+        source=np.array(source),
+        dest=np.array(dest),
+        old_index=np.array([d.old_index for d in diffs], dtype=np.int64),
+        new_index=np.array([d.new_index for d in diffs], dtype=np.int64),
+        old_lengths=np.array(
+            [sum(len(s) for s in d.old_tokens) for d in diffs],
+            dtype=np.int64),
+        new_lengths=np.array(
+            [sum(len(s) for s in d.new_tokens) for d in diffs],
+            dtype=np.int64),
+        alignment=np.array(alignment, dtype=np.int32))
+
+
+def load_diffs(f):
+    """Load the diffs of a binary diff file, without any tokens.
+
+    old_sentence and new_sentence are None unless the file has sentence
+    pairs, and diff_type and diff_scope are None unless it has categories.
+    alignment is None in files written before alignments were persisted.
+    """
+    with np.load(f) as arrays:
+        _check_version(arrays)
+        return BinaryDiffs(str(arrays['part']), str(arrays['source']),
+                           str(arrays['dest']), arrays['old_index'],
+                           arrays['new_index'], arrays['old_lengths'],
+                           arrays['new_lengths'], arrays.get('alignment'),
+                           arrays.get('old_sentence'),
+                           arrays.get('new_sentence'),
+                           arrays.get('diff_type'),
+                           arrays.get('diff_scope'))
+
+
+def load_document_diff(storage, forum_id, name):
+    """Load a forum's diff file in either format as the object written by
+    DocumentDiff.dump.
+    """
+    if not name.endswith(".npz"):
+        with storage.open(forum_id, name, 'r') as f:
+            return json.load(f)
+
+    with storage.open(forum_id, name, 'rb') as f:
+        binary_diffs = load_diffs(f)
+    unflat_tokens = {}
+    flat_tokens = {}
+    sentence_offsets = {}
+    for version in [binary_diffs.source, binary_diffs.dest]:
+        with storage.open(forum_id,
+                          get_token_store_name(binary_diffs.part, version),
+                          'rb') as f:
+            unflat_tokens[version] = load_tokens(f)
+        flat_tokens[version] = list(
+            itertools.chain.from_iterable(unflat_tokens[version]))
+        sentence_offsets[version] = get_sentence_offsets(
+            unflat_tokens[version])
+
+    diffs = []
+    for old_index, new_index, old_length, new_length in zip(
+            binary_diffs.old_index.tolist(), binary_diffs.new_index.tolist(),
+            binary_diffs.old_lengths.tolist(),
+            binary_diffs.new_lengths.tolist()):
+        diffs.append({
+            "old_index":
+            old_index,
+            "new_index":
+            new_index,
+            "old_tokens":
+            split_into_sentences(flat_tokens[binary_diffs.source],
+                                 old_index + 1, old_index + 1 + old_length,
+                                 sentence_offsets[binary_diffs.source]),
+            "new_tokens":
+            split_into_sentences(flat_tokens[binary_diffs.dest],
+                                 new_index + 1, new_index + 1 + new_length,
+                                 sentence_offsets[binary_diffs.dest]),
+        })
+
+    obj = {
+        "tokens": {
+            "source": unflat_tokens[binary_diffs.source],
+            "dest": unflat_tokens[binary_diffs.dest]
+        },
+        "diffs": diffs
+    }
+    if binary_diffs.alignment is not None:
+        obj["alignment"] = binary_diffs.alignment.tolist()
+    if binary_diffs.diff_type is not None:
+        obj["categories"] = [[diff_type, diff_scope]
+                             for diff_type, diff_scope in zip(
+                                 binary_diffs.diff_type.tolist(),
+                                 binary_diffs.diff_scope.tolist())]
+    if binary_diffs.old_sentence is not None:
+        obj["sentence_pairs"] = [{
+            "old_sentence": None if old_sentence == -1 else old_sentence,
+            "new_sentence": None if new_sentence == -1 else new_sentence,
+        } for old_sentence, new_sentence in zip(
+            binary_diffs.old_sentence.tolist(),
+            binary_diffs.new_sentence.tolist())]
+    return obj
@@ -5,16 +5,22 @@
 #SBATCH --error=logs/download_%A_%a.err
 #SBATCH -p gpu  # Partition
 #SBATCH -G 1  # Number of GPUs
-#SBATCH --array=0-5
+#SBATCH --array=0-7
 #SBATCH --time=1-00:00:00
 #SBATCH --time-min=0-08:00:00
 
-array=( $(seq 2018 2023 ) )
+# Each task processes one shard of the forums of every conference, so the
+# tasks finish at about the same time. Afterwards, merge the per-shard record
+# files with run_00_merge_records.sh, e.g.
+#   sbatch --dependency=afterok:<job id> run_00_merge_records.sh
 
 module load conda/latest
 conda activate latmod_env
 cd /work/pi_mccallum_umass_edu/nnayak_umass_edu/latourian_modality/00_extract_data
-python 00_download.py \
-	-d /gypsum/work1/mccallum/nnayak/latmod/\
-	-c iclr_${array[$SLURM_ARRAY_TASK_ID]}
-
+for year in $(seq 2018 2023); do
+	python 00_download.py \
+		-d /gypsum/work1/mccallum/nnayak/latmod/ \
+		-c iclr_${year} \
+		--num_shards $SLURM_ARRAY_TASK_COUNT \
+		--shard_index $SLURM_ARRAY_TASK_ID
+done
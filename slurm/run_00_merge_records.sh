@@ -0,0 +1,11 @@
+#!/bin/bash
+#SBATCH --job-name=latmod_merge_records
+#SBATCH --nodes=1 --ntasks=1
+#SBATCH --output=logs/merge_records_%j.out
+#SBATCH --error=logs/merge_records_%j.err
+#SBATCH --time=0-01:00:00
+
+module load conda/latest
+conda activate latmod_env
+cd /work/pi_mccallum_umass_edu/nnayak_umass_edu/latourian_modality/00_extract_data
+python merge_records.py
@@ -0,0 +1,30 @@
+#!/bin/bash
+#SBATCH --job-name=latmod_pipeline
+#SBATCH --nodes=1 --ntasks=1
+#SBATCH --cpus-per-task=16
+#SBATCH --output=logs/pipeline_%A_%a.out
+#SBATCH --error=logs/pipeline_%A_%a.err
+#SBATCH -p gpu  # Partition
+#SBATCH -G 1  # Number of GPUs
+#SBATCH --array=0-7
+#SBATCH --time=1-00:00:00
+#SBATCH --time-min=0-08:00:00
+
+# Each task processes one shard of the forums of every conference, so the
+# tasks finish at about the same time. Afterwards, merge the per-shard record
+# files with run_00_merge_records.sh, e.g.
+#   sbatch --dependency=afterok:<job id> run_00_merge_records.sh
+
+module load conda/latest
+conda activate latmod_env
+export PATH=$PATH:/work/pi_mccallum_umass_edu/nnayak_umass_edu/latourian_modality/00_extract_data/xpdf-tools-linux-4.05/bin64
+
+cd /work/pi_mccallum_umass_edu/nnayak_umass_edu/latourian_modality/00_extract_data
+for year in $(seq 2018 2023); do
+	python pipeline.py \
+		-d /gypsum/work1/mccallum/nnayak/latmod/ \
+		--compute_workers $SLURM_CPUS_PER_TASK \
+		-c iclr_${year} \
+		--num_shards $SLURM_ARRAY_TASK_COUNT \
+		--shard_index $SLURM_ARRAY_TASK_ID
+done